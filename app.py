@@ -1,54 +1,505 @@
+import io
 import os
 import re
+import sys
+import signal
+import socket
+import json
+import sqlite3
+import struct
+import hashlib
+import gzip
+import argparse
+import cProfile
+from array import array
+from contextlib import contextmanager
+from functools import lru_cache
+from collections.abc import Sequence
+import numpy as np
 import pydicom
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+from pydicom.valuerep import PersonName
+from pydicom.dataelem import RawDataElement
+from pydicom.datadict import tag_for_keyword
+from pydicom.tag import Tag
+from pydicom.uid import (
+	ImplicitVRLittleEndian,
+	ExplicitVRLittleEndian,
+	ExplicitVRBigEndian,
+	DeflatedExplicitVRLittleEndian,
+)
 from loguru import logger
-from func_timeout import func_set_timeout, FunctionTimedOut
+from func_timeout import FunctionTimedOut
 import SimpleITK as sitk
 import tkinter as tk
-from tkinter import filedialog, messagebox, scrolledtext
+from tkinter import filedialog, messagebox, scrolledtext, ttk
+import queue
+import threading
+import time
 from threading import Thread
-from dataclasses import dataclass
-from collections import Counter
+from dataclasses import dataclass, field
+from collections import Counter, deque
+from concurrent.futures import (
+	ThreadPoolExecutor,
+	ProcessPoolExecutor,
+	wait,
+	as_completed,
+	FIRST_COMPLETED,
+)
+from itertools import chain, islice
+import multiprocessing
+from multiprocessing import freeze_support
 
-# from tqdm.auto import tqdm
+try:  # 可选依赖, 没有时 watch 使用轮询
+	from watchdog.observers import Observer
+	from watchdog.events import FileSystemEventHandler
+except ImportError:
+	Observer = None
+	FileSystemEventHandler = object
 
-# from joblib import Parallel, delayed
-# from multiprocessing import freeze_support
+# from tqdm.auto import tqdm
 
 _version = "1.74"
 
+# GUI / 命令行默认读取的元数据
+APP_META_KEYS = [
+	"PatientID",
+	"StudyID",
+	"AccessionNumber",
+	"ProtocolName",
+	"SeriesInstanceUID",
+	"SliceLocation",
+	"InstanceNumber",
+	"SeriesNumber",
+	"SeriesDescription",
+	"AcquisitionTime",
+]
 
-@logger.catch
-def get_dicom_file(root_path, timeout=2):
-	@func_set_timeout(timeout)
-	def get_dicom_file_inner(root_path):
-		return_files = []
-		for root, dirs, files in os.walk(root_path):
-			if not dirs:
-				for file in files:
-					return_files.append(os.path.join(root, file))
-		return return_files
+
+def iter_dicom_file(root_path, timeout=2, n_jobs=1):
+	"""
+	使用 os.scandir 递归遍历 root_path, 边遍历边返回文件路径
+	n_jobs: 并行遍历子目录的线程数
+	timeout: 卡死检测, 超过 timeout 秒没有遍历到新的条目时抛出 FunctionTimedOut
+	"""
+	files = queue.Queue(maxsize=4096)
+	dirs = queue.Queue()
+	dirs.put(root_path)
+	pending = [1]  # 尚未遍历完的目录数
+	lock = threading.Lock()
+	last_progress = [time.monotonic()]
+	done = threading.Event()
+	stop = threading.Event()
+
+	def put_file(path):
+		while not stop.is_set():
+			try:
+				files.put(path, timeout=0.1)
+				return
+			except queue.Full:  # 下游处理较慢, 不算卡死
+				last_progress[0] = time.monotonic()
+
+	def walker():
+		while not done.is_set() and not stop.is_set():
+			try:
+				path = dirs.get(timeout=0.1)
+			except queue.Empty:
+				continue
+			try:
+				with os.scandir(path) as it:
+					for entry in it:
+						last_progress[0] = time.monotonic()
+						if stop.is_set():
+							return
+						try:
+							if entry.is_dir():
+								if not entry.is_symlink():
+									with lock:
+										pending[0] += 1
+									dirs.put(entry.path)
+							elif entry.is_file():
+								put_file(entry.path)
+						except OSError as e:
+							logger.warning(f"Error in reading {entry.path}. Error: {e}, Will Skip.")
+			except OSError as e:
+				logger.warning(f"Error in reading {path}. Error: {e}, Will Skip.")
+			finally:
+				with lock:
+					pending[0] -= 1
+					if pending[0] == 0:
+						done.set()
+
+	for _ in range(get_n_jobs(n_jobs)):
+		Thread(target=walker, daemon=True).start()
 
 	try:
-		return get_dicom_file_inner(root_path)
-	except FunctionTimedOut:
-		logger.error(f"Timeout when reading {root_path}.")
-		raise FunctionTimedOut(
-			f"Timeout when reading {root_path}. maybe the path does not contain DICOM files or too many files. "
-			f"If you are sure that the path contains DICOM files, you can increase the timeout limit."
-		)
+		while True:
+			try:
+				yield files.get(timeout=0.1)
+			except queue.Empty:
+				if done.is_set() and files.empty():
+					return
+				if time.monotonic() - last_progress[0] > timeout:
+					logger.error(f"Timeout when reading {root_path}.")
+					raise FunctionTimedOut(
+						f"Timeout when reading {root_path}, no new file in {timeout} seconds. "
+						f"Maybe the path is not accessible. If the storage is slow, you can increase the timeout limit."
+					)
+	finally:
+		stop.set()
 
 
 @logger.catch
-def get_metadata(dicom_file, meta_keys=None):
-	try:
-		ds = pydicom.dcmread(dicom_file, force=True)
-	except Exception as e:
-		logger.warning(f"Error in reading {dicom_file}. Error: {e}, Will Skip.")
-		# raise ValueError(f"Error in reading {dicom_file}. Error: {e}")
+def get_dicom_file(root_path, timeout=2, n_jobs=1):
+	return list(iter_dicom_file(root_path, timeout=timeout, n_jobs=n_jobs))
+
+
+_EXPLICIT_VRS = {
+	b"AE", b"AS", b"AT", b"CS", b"DA", b"DS", b"DT", b"FD", b"FL", b"IS",
+	b"LO", b"LT", b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"PN", b"SH",
+	b"SL", b"SQ", b"SS", b"ST", b"SV", b"TM", b"UC", b"UI", b"UL", b"UN",
+	b"UR", b"US", b"UT", b"UV",
+}
+_EXPLICIT_LONG_VRS = {
+	b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN",
+	b"UR", b"UT", b"UV",
+}
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_ITEM_TAG = 0xFFFEE000
+_ITEM_DELIMITER_TAG = 0xFFFEE00D
+_SEQUENCE_DELIMITER_TAG = 0xFFFEE0DD
+_SPECIFIC_CHARACTER_SET_TAG = 0x00080005
+_TRANSFER_SYNTAX_UID_TAG = 0x00020010
+
+
+NOT_DICOM = "[NOT_DICOM]"
+
+
+@contextmanager
+def open_binary(dicom_file, fp=None):
+	"""fp 为 None 时打开 dicom_file, 否则回到 fp 开头直接使用 (不关闭)"""
+	if fp is None:
+		with open(dicom_file, "rb") as fp:
+			yield fp
+	else:
+		fp.seek(0)
+		yield fp
+
+
+def is_dicom_file(dicom_file, fp=None):
+	"""
+	读取文件前 132 字节判断是否为 DICOM 文件
+	有 128 字节前导和 DICM 标记的直接通过; 没有前导的文件检查第一个元素是否像 DICOM 元素
+	"""
+	if os.path.basename(dicom_file).upper() == "DICOMDIR":
+		return False
+
+	with open_binary(dicom_file, fp) as fp:
+		header = fp.read(132)
+
+	if header[128:132] == b"DICM":
+		return True
+	if len(header) < 8:
+		return False
+
+	if header[:2] == b"\x00\x08":  # 无文件头的 Big Endian
+		return header[4:6] in _EXPLICIT_VRS
+	group = struct.unpack_from("<H", header)[0]
+	if group not in (0x0000, 0x0002, 0x0008):
+		return False
+	if header[4:6] in _EXPLICIT_VRS:  # 显式 VR
+		return True
+	return struct.unpack_from("<L", header, 4)[0] < 0x10000  # 隐式 VR, 长度合理
+
+
+@lru_cache(maxsize=None)
+def _keywords_to_tags(meta_keys):
+	tags = [tag_for_keyword(k) for k in meta_keys]
+	if None in tags:
+		return None
+	return frozenset(tags)
+
+
+def _read_element_header(fp, implicit):
+	header = fp.read(8)
+	if len(header) < 8:
 		return None
+	group, element = struct.unpack_from("<HH", header)
+	tag = group << 16 | element
+	# Item 和 Delimiter 总是 tag + 4 字节长度
+	if implicit or group == 0xFFFE:
+		return tag, None, struct.unpack_from("<L", header, 4)[0]
+	vr = header[4:6]
+	if vr in _EXPLICIT_LONG_VRS:
+		return tag, vr, struct.unpack("<L", fp.read(4))[0]
+	return tag, vr, struct.unpack_from("<H", header, 6)[0]
+
+
+def _skip_undefined_length(fp, implicit):
+	"""跳过未定义长度的序列 (逐个 Item 跳到 Sequence Delimiter)"""
+	while True:
+		header = _read_element_header(fp, True)
+		if header is None:
+			raise EOFError("Unexpected end of file in sequence")
+		tag, _, length = header
+		if tag == _SEQUENCE_DELIMITER_TAG:
+			return
+		if tag != _ITEM_TAG:
+			raise ValueError(f"Unexpected tag {tag:08X} in sequence")
+		if length != _UNDEFINED_LENGTH:
+			fp.seek(length, 1)
+			continue
+		while True:
+			header = _read_element_header(fp, implicit)
+			if header is None:
+				raise EOFError("Unexpected end of file in item")
+			tag, vr, length = header
+			if tag == _ITEM_DELIMITER_TAG:
+				break
+			if length == _UNDEFINED_LENGTH:
+				_skip_undefined_length(fp, implicit or vr == b"UN")
+			else:
+				fp.seek(length, 1)
+
+
+def read_raw_header(dicom_file, tags, fp=None, truncated=False):
+	"""
+	快速读取 DICOM 头: 只保留 tags 中的顶层元素, 读到比最大目标标签更大的元素时立即停止
+	只支持 Little Endian (显式/隐式 VR), 其他传输语法返回 None, 由 pydicom 回退处理
+	返回的 Dataset 由 pydicom 按需转换元素值, 与 dcmread 的结果一致
+	truncated: fp 只包含文件开头的部分字节, 未读到最大目标标签之后就结束时抛出 EOFError
+	"""
+	wanted = set(tags) | {_SPECIFIC_CHARACTER_SET_TAG}
+	stop_tag = max(wanted)
+
+	with open_binary(dicom_file, fp) as fp:
+		if fp.read(132)[128:132] != b"DICM":
+			fp.seek(0)
+
+		# File Meta Information (0002,xxxx) 总是显式 VR Little Endian
+		transfer_syntax = None
+		while True:
+			tell = fp.tell()
+			header = _read_element_header(fp, False)
+			if header is None or header[0] >> 16 != 0x0002:
+				fp.seek(tell)
+				break
+			tag, _, length = header
+			if tag == _TRANSFER_SYNTAX_UID_TAG:
+				transfer_syntax = fp.read(length).rstrip(b"\0 ").decode("ascii")
+			else:
+				fp.seek(length, 1)
+
+		if transfer_syntax in (
+			ExplicitVRBigEndian,
+			DeflatedExplicitVRLittleEndian,
+		):
+			return None
+
+		# 与 pydicom 一致, 以 VR 位置的实际字节为准 (部分文件声明与编码不符)
+		tell = fp.tell()
+		first = fp.read(6)
+		fp.seek(tell)
+		if transfer_syntax is None and first[:2] == b"\x00\x08":
+			return None  # 无文件头的 Big Endian
+		implicit = first[4:6] not in _EXPLICIT_VRS
+
+		elements = {}
+		while True:
+			header = _read_element_header(fp, implicit)
+			if header is None:
+				if truncated:
+					raise EOFError("Header exceeds the prefetched bytes")
+				break
+			tag, vr, length = header
+			if tag > stop_tag:
+				break
+			if length == _UNDEFINED_LENGTH:
+				_skip_undefined_length(fp, implicit or vr == b"UN")
+			elif tag in wanted:
+				value_tell = fp.tell()
+				elements[Tag(tag)] = RawDataElement(
+					Tag(tag),
+					None if implicit else vr.decode("ascii"),
+					length,
+					fp.read(length),
+					value_tell,
+					implicit,
+					True,
+				)
+			else:
+				fp.seek(length, 1)
+
+	return Dataset(elements)
+
+
+def read_header(dicom_file, meta_keys, fast=False, fp=None):
+	"""
+	只读取 DICOM 头中 meta_keys 对应的标签, 不读取 PixelData
+	fast: 使用 read_raw_header 直接解析字节, 不支持时回退到 pydicom
+	fp: 已打开的二进制文件对象 (或内存缓冲区), 为 None 时按路径打开
+	"""
+	if fast:
+		tags = _keywords_to_tags(tuple(meta_keys))
+		if tags is not None:
+			try:
+				ds = read_raw_header(dicom_file, tags, fp)
+			except (OSError, ValueError, EOFError, struct.error) as e:
+				logger.debug(f"Fast read failed in {dicom_file}: {e}, fallback.")
+				ds = None
+			if ds is not None:
+				return ds
+
+	if fp is not None:
+		fp.seek(0)
+	return pydicom.dcmread(
+		dicom_file if fp is None else fp,
+		force=True,
+		stop_before_pixels=True,
+		specific_tags=list(meta_keys),
+	)
+
+
+def native_value(value):
+	"""
+	把 pydicom 的元素值转换为原生类型: DSfloat -> float, IS -> int, UID / PersonName -> 驻留的 str,
+	MultiValue -> tuple; 比较和排序结果与原值一致
+	"""
+	if isinstance(value, str):
+		return sys.intern(str(value))
+	if isinstance(value, bool):
+		return value
+	if isinstance(value, int):
+		return int(value)
+	if isinstance(value, float):
+		return float(value)
+	if isinstance(value, PersonName):
+		return sys.intern(str(value))
+	if isinstance(value, (MultiValue, list)):
+		return tuple(native_value(x) for x in value)
+	return value
 
-	d = {"file_path": dicom_file}
+
+@lru_cache(maxsize=None)
+def _record_index(keys):
+	return {k: i for i, k in enumerate(keys)}
+
+
+class SliceRecord:
+	"""
+	单个切片的元数据, 代替 {"file_path": ..., key: value} 字典
+	值为原生类型 (见 native_value), 同一组 meta_keys 的记录共用键的索引;
+	路径拆分为目录前缀 (驻留, 同目录的切片共用) 和文件名
+	支持 record[key], get, keys, in 和 dict(record), 与原字典的用法兼容
+	"""
+
+	__slots__ = ("_index", "prefix", "name", "values")
+
+	def __init__(self, keys, file_path, values):
+		name = os.path.basename(file_path)
+		self._index = _record_index(tuple(keys))
+		self.prefix = sys.intern(file_path[: len(file_path) - len(name)])
+		self.name = name
+		self.values = tuple(native_value(x) for x in values)
+
+	@classmethod
+	def from_dict(cls, d):
+		keys = [k for k in d if k != "file_path"]
+		return cls(keys, d["file_path"], [d[k] for k in keys])
+
+	@property
+	def file_path(self):
+		return self.prefix + self.name
+
+	def __getitem__(self, key):
+		i = self._index.get(key)
+		if i is not None:
+			return self.values[i]
+		if key == "file_path":
+			return self.prefix + self.name
+		raise KeyError(key)
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def __contains__(self, key):
+		return key == "file_path" or key in self._index
+
+	def keys(self):
+		return ["file_path", *self._index]
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self._index) + 1
+
+	def __eq__(self, other):
+		if isinstance(other, (SliceRecord, dict)):
+			return dict(self) == dict(other)
+		return NotImplemented
+
+	def __repr__(self):
+		return f"SliceRecord({dict(self)})"
+
+	def __reduce__(self):
+		# 进程间传递和缓存时只保存键, 路径和值; 重建时重新驻留字符串
+		return (
+			SliceRecord,
+			(tuple(self._index), self.prefix + self.name, self.values),
+		)
+
+
+class FileList(Sequence):
+	"""
+	由 SliceRecord 的目录前缀和文件名组成的路径列表, 不保存拼接后的路径, 访问时拼接
+	可以像 list 一样索引, 切片, 迭代和比较; 需要真正的 list 时使用 list(files)
+	"""
+
+	__slots__ = ("prefixes", "names")
+
+	def __init__(self, prefixes, names):
+		self.prefixes = tuple(prefixes)
+		self.names = tuple(names)
+
+	@classmethod
+	def from_records(cls, records):
+		# 自定义 filter_func 可能返回字典
+		records = [
+			x if isinstance(x, SliceRecord) else SliceRecord((), x["file_path"], ())
+			for x in records
+		]
+		return cls([x.prefix for x in records], [x.name for x in records])
+
+	def __len__(self):
+		return len(self.names)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return FileList(self.prefixes[i], self.names[i])
+		return self.prefixes[i] + self.names[i]
+
+	def __iter__(self):
+		return map(str.__add__, self.prefixes, self.names)
+
+	def __eq__(self, other):
+		if isinstance(other, Sequence) and not isinstance(other, str):
+			return len(self) == len(other) and all(
+				x == y for x, y in zip(self, other)
+			)
+		return NotImplemented
+
+	def __repr__(self):
+		return f"FileList({list(self)})"
+
+
+def extract_metadata(ds, dicom_file, meta_keys):
+	"""从已读取的 Dataset 中提取 meta_keys, 返回 SliceRecord, 缺少检查号时返回 None"""
+	d = {}
 
 	for k in meta_keys:
 		d[k] = ds.get(k, "[NA]")
@@ -64,74 +515,389 @@ def get_metadata(dicom_file, meta_keys=None):
 	if "[NA]" != d["AcquisitionTime"] and d["AcquisitionTime"] != "":
 		d["AcquisitionTime"] = str(round(float(d["AcquisitionTime"])))
 
-	return d
+	return SliceRecord(d, dicom_file, d.values())
 
 
-def filter_in(x: dict):
+@logger.catch
+def get_metadata(dicom_file, meta_keys=None, fast=False, fp=None):
+	try:
+		ds = read_header(dicom_file, meta_keys, fast=fast, fp=fp)
+	except Exception as e:
+		logger.warning(f"Error in reading {dicom_file}. Error: {e}, Will Skip.")
+		# raise ValueError(f"Error in reading {dicom_file}. Error: {e}")
+		return None
+
+	return extract_metadata(ds, dicom_file, meta_keys)
+
+
+@logger.catch(default=(None, None))
+def get_metadata_and_slice(dicom_file, meta_keys=None, fp=None):
 	"""
-	根据序列描述和厂商信息过滤序列
-	x: dict
+	完整读取一次文件, 同时返回 (metadata, SliceData)
+	像素无法直接组装为体数据 (多帧、彩色等) 时 SliceData 为 None, 导出时再读取
 	"""
-	if any(  # 通用过滤
-		[
-			i == x["SeriesDescription"].lower()
-			for i in [
-				"localizer",
-				"3-pl loc",
-				"3-pl loc ssfse",
-				"3-pl ssfse loc",
-				"processed images",
-				"screen save",
-				"default ps series",
-				"survey",
-			]
-		]
-	):
-		return False
+	try:
+		if fp is not None:
+			fp.seek(0)
+		ds = pydicom.dcmread(dicom_file if fp is None else fp, force=True)
+	except Exception as e:
+		logger.warning(f"Error in reading {dicom_file}. Error: {e}, Will Skip.")
+		return None, None
 
-	if "Philips" in x["Manufacturer"] and (
-		any(  # 有的序列描述中包含以下关键字
-			[
-				i in x["SeriesDescription"]
-				for i in [
-					"RECON",
-				]
-			]
+	metadata = extract_metadata(ds, dicom_file, meta_keys)
+	if metadata is None:
+		return None, None
+
+	try:
+		slice_data = read_slice(ds)
+	except Exception as e:
+		logger.debug(f"Keep no pixels of {dicom_file}: {e}")
+		slice_data = None
+	return metadata, slice_data
+
+
+def get_n_jobs(n_jobs):
+	"""n_jobs 为 None 或负数时使用全部 CPU"""
+	if n_jobs is None or n_jobs < 0:
+		return os.cpu_count() or 1
+	return max(1, n_jobs)
+
+
+def get_executor(n_jobs, backend=None):
+	"""
+	根据 n_jobs 和 backend 创建并行执行器
+	backend: None / "threading" 使用线程池;
+		"loky" / "multiprocessing" 使用默认启动方式的进程池;
+		"spawn" / "fork" / "forkserver" 使用指定启动方式的进程池
+	"""
+	n_jobs = get_n_jobs(n_jobs)
+
+	if backend is None or backend == "threading":
+		return ThreadPoolExecutor(max_workers=n_jobs)
+
+	if backend in ("loky", "multiprocessing"):
+		return ProcessPoolExecutor(max_workers=n_jobs)
+
+	if backend in multiprocessing.get_all_start_methods():
+		return ProcessPoolExecutor(
+			max_workers=n_jobs,
+			mp_context=multiprocessing.get_context(backend),
 		)
-		or any(  # 有的序列描述中等于以下关键字
-			[
-				i == x["SeriesDescription"]
-				for i in [
-					"IN",
-					"OP",
-					"WATER",
-					"ALL",
-					"A1",
-					"A2",
-					"A60",
-					"V60",
-					"3min",
-					"8min",
-				]
-			]
+
+	raise ValueError(f"Unknown backend {backend}")
+
+
+def iter_chunks(iterable, size):
+	iterator = iter(iterable)
+	while True:
+		chunk = list(islice(iterator, size))
+		if not chunk:
+			return
+		yield chunk
+
+
+def read_file_metadata(
+	dicom_file,
+	meta_keys=None,
+	fast=False,
+	sniff=False,
+	with_pixels=False,
+	opener=None,
+	fp=None,
+):
+	"""
+	返回 (metadata, SliceData)
+	sniff 为 True 时先检查文件头, 不是 DICOM 文件时 metadata 为 NOT_DICOM
+	with_pixels 为 True 时完整读取文件并保留像素, 否则 SliceData 为 None
+	opener: 打开文件的函数 (如 open), 给出时只打开一次文件, 检查和解析共用同一个文件对象
+	"""
+	if opener is not None and fp is None:
+		try:
+			with opener(dicom_file, "rb") as fp:
+				return read_file_metadata(
+					dicom_file, meta_keys, fast, sniff, with_pixels, fp=fp
+				)
+		except OSError as e:
+			logger.warning(f"Error in reading {dicom_file}. Error: {e}, Will Skip.")
+			return None, None
+	if sniff:
+		try:
+			if not is_dicom_file(dicom_file, fp):
+				logger.debug(f"{dicom_file} is not a DICOM file, will skip.")
+				return NOT_DICOM, None
+		except OSError as e:
+			logger.warning(f"Error in reading {dicom_file}. Error: {e}, Will Skip.")
+			return None, None
+	if with_pixels:
+		return get_metadata_and_slice(dicom_file, meta_keys, fp)
+	return get_metadata(dicom_file, meta_keys, fast, fp), None
+
+
+@logger.catch(default=(None, None))
+def read_buffer_metadata(
+	dicom_file,
+	data,
+	meta_keys=None,
+	fast=False,
+	sniff=False,
+	with_pixels=False,
+	complete=False,
+	opener=open,
+):
+	"""
+	从预读到内存的字节 data 解析元数据, 返回值与 read_file_metadata 相同
+	complete 为 True 时 data 是整个文件, 与 read_file_metadata 的处理完全相同;
+	否则 data 只是文件开头, 用 read_raw_header 解析并确认所需标签都在 data 中,
+	标签超出 data 或传输语法不支持时通过 opener 重新读取文件
+	"""
+	fp = io.BytesIO(data)
+	if complete:
+		return read_file_metadata(
+			dicom_file, meta_keys, fast, sniff, with_pixels, fp=fp
 		)
+
+	if sniff and not is_dicom_file(dicom_file, fp):
+		logger.debug(f"{dicom_file} is not a DICOM file, will skip.")
+		return NOT_DICOM, None
+	tags = None if meta_keys is None else _keywords_to_tags(tuple(meta_keys))
+	if tags is not None:
+		try:
+			ds = read_raw_header(dicom_file, tags, fp, truncated=True)
+		except (ValueError, EOFError, struct.error) as e:
+			logger.debug(f"Prefetched bytes of {dicom_file} are not enough: {e}")
+			ds = None
+		if ds is not None:
+			return extract_metadata(ds, dicom_file, meta_keys), None
+	return read_file_metadata(
+		dicom_file, meta_keys, fast, with_pixels=with_pixels, opener=opener
+	)
+
+
+def read_timed(
+	dicom_file, meta_keys=None, fast=False, sniff=False, with_pixels=False, opener=None
+):
+	"""返回 (metadata, SliceData, 耗时)"""
+	start = time.perf_counter()
+	metadata, slice_data = read_file_metadata(
+		dicom_file, meta_keys, fast, sniff, with_pixels, opener
+	)
+	return metadata, slice_data, time.perf_counter() - start
+
+
+def read_metadata_chunk(
+	dicom_files, meta_keys=None, fast=False, sniff=False, with_pixels=False, opener=None
+):
+	return [
+		read_timed(file, meta_keys, fast, sniff, with_pixels, opener)
+		for file in dicom_files
+	]
+
+
+class Prefetcher:
+	"""
+	元数据预读层: 在线程池中读取每个文件开头的 prefetch_bytes 字节, 按输入顺序交给解析
+	一次较大的读取代替 pydicom 的多次小读取, 适合单次往返延迟高的网络存储
+	在途读取数在 [min_outstanding, max_outstanding] 之间按观察到的延迟自适应调整:
+	每个窗口按 最小延迟 / 当前延迟 缩放并加上 sqrt(在途数) 的余量,
+	存储未饱和时延迟不变, 在途数逐步增加; 排队导致延迟上升时在途数随之下降
+	opener: 打开文件的函数, 默认 open, 测试时可以注入带延迟的假文件系统
+	"""
+
+	def __init__(
+		self,
+		max_outstanding=32,
+		prefetch_bytes=64 * 1024,
+		opener=open,
+		min_outstanding=2,
+		adaptive=True,
 	):
-		return False
-	if "GE" in x["Manufacturer"] and (
-		any(  # 有的序列描述中包含以下关键字
-			[
-				i in x["SeriesDescription"]
-				for i in [
-					"ORIG",
-					"MPR",
-					"Refomate",
-					"IDEAL IQ",
-				]
-			]
-		)
-		or any(  # 有的序列描述中等于以下关键字
-			i == x["SeriesDescription"]
-			for i in [
+		self.max_outstanding = max(1, max_outstanding)
+		self.min_outstanding = max(1, min(min_outstanding, self.max_outstanding))
+		self.prefetch_bytes = prefetch_bytes
+		self.opener = opener
+		self.adaptive = adaptive
+		self._limit = self.min_outstanding if adaptive else self.max_outstanding
+		self.min_latency = None
+		self.limits = []  # 每个窗口调整后的在途数, 用于观察
+		self._window = []
+
+	@property
+	def limit(self):
+		return int(self._limit)
+
+	def observe(self, seconds):
+		"""记录一次读取的延迟, 每 limit 次读取调整一次在途数"""
+		if not self.adaptive:
+			return
+		self._window.append(seconds)
+		if len(self._window) < self.limit:
+			return
+		latency = float(np.median(self._window))
+		self._window.clear()
+		if self.min_latency is None or latency < self.min_latency:
+			self.min_latency = latency
+		limit = self._limit * self.min_latency / max(latency, 1e-9)
+		limit += self._limit**0.5
+		self._limit = min(self.max_outstanding, max(self.min_outstanding, limit))
+		self.limits.append(self.limit)
+
+	def read(self, dicom_file, whole=False):
+		"""返回 (data, 耗时), whole 为 True 时读取整个文件, 读取失败时 data 为异常对象"""
+		start = time.perf_counter()
+		try:
+			with self.opener(dicom_file, "rb") as fp:
+				data = fp.read() if whole else fp.read(self.prefetch_bytes)
+		except OSError as e:
+			data = e
+		return data, time.perf_counter() - start
+
+	def __call__(self, dicom_files, whole=None):
+		"""
+		按输入顺序逐个返回 (file, data, 是否为整个文件, 耗时)
+		whole: threading.Event, 提交读取时处于 set 状态则读取整个文件 (single_pass 需要像素)
+		"""
+		with ThreadPoolExecutor(max_workers=self.max_outstanding) as executor:
+			futures = deque()
+
+			def result():
+				file, is_whole, future = futures.popleft()
+				data, seconds = future.result()
+				if not isinstance(data, Exception):
+					self.observe(seconds)
+				return file, data, is_whole, seconds
+
+			for file in dicom_files:
+				is_whole = whole is not None and whole.is_set()
+				futures.append((file, is_whole, executor.submit(self.read, file, is_whole)))
+				while len(futures) >= self.limit:
+					yield result()
+			while futures:
+				yield result()
+
+
+def read_metadata_list(
+	dicom_files,
+	meta_keys=None,
+	n_jobs=1,
+	backend=None,
+	fast=False,
+	sniff=False,
+	with_pixels=None,
+	opener=None,
+	prefetch=None,
+):
+	"""
+	并行读取 dicom_files (可以是生成器) 的元数据
+	按输入顺序逐个返回 (file, metadata, SliceData, 耗时), 读取失败时 metadata 为 None, 非 DICOM 文件为 NOT_DICOM
+	with_pixels: threading.Event, 提交读取任务时处于 set 状态则同时读取像素
+	opener: 打开文件的函数, 为 None 时按路径直接读取
+	prefetch: Prefetcher, 给出时由它并发读取文件开头, n_jobs 和 backend 不再使用
+	"""
+
+	def read_pixels():
+		return with_pixels is not None and with_pixels.is_set()
+
+	if prefetch is not None:
+		# 读取由预读层并发完成, 内存中的解析开销很小, 在当前线程进行
+		for file, data, whole, seconds in prefetch(dicom_files, with_pixels):
+			if isinstance(data, Exception):
+				logger.warning(f"Error in reading {file}. Error: {data}, Will Skip.")
+				yield file, None, None, seconds
+				continue
+			start = time.perf_counter()
+			metadata, slice_data = read_buffer_metadata(
+				file,
+				data,
+				meta_keys,
+				fast,
+				sniff,
+				with_pixels=whole,
+				complete=whole or len(data) < prefetch.prefetch_bytes,
+				opener=prefetch.opener,
+			)
+			yield file, metadata, slice_data, seconds + time.perf_counter() - start
+		return
+
+	n_jobs = get_n_jobs(n_jobs)
+	if n_jobs == 1:
+		for file in dicom_files:
+			yield (
+				file,
+				*read_timed(file, meta_keys, fast, sniff, read_pixels(), opener),
+			)
+		return
+
+	# 进程池按块分发, 降低进程间通信开销
+	chunksize = 1 if backend is None or backend == "threading" else 16
+	with get_executor(n_jobs, backend) as executor:
+		futures = deque()
+		for chunk in iter_chunks(dicom_files, chunksize):
+			futures.append(
+				(
+					chunk,
+					executor.submit(
+						read_metadata_chunk,
+						chunk,
+						meta_keys,
+						fast,
+						sniff,
+						read_pixels(),
+						opener,
+					),
+				)
+			)
+			while len(futures) >= n_jobs * 4:  # 限制在途任务数
+				chunk, future = futures.popleft()
+				for file, result in zip(chunk, future.result()):
+					yield (file, *result)
+		while futures:
+			chunk, future = futures.popleft()
+			for file, result in zip(chunk, future.result()):
+				yield (file, *result)
+
+
+# 默认过滤规则, 与原 filter_in 一致; 可保存为 JSON 修改后通过 filter_rules 加载
+# exact: 序列描述等于, exact_lower: 小写后等于, contains: 序列描述包含
+# vendors 中的键包含在 Manufacturer 中时应用对应规则
+DEFAULT_FILTER_RULES = {
+	"common": {
+		"exact_lower": [
+			"localizer",
+			"3-pl loc",
+			"3-pl loc ssfse",
+			"3-pl ssfse loc",
+			"processed images",
+			"screen save",
+			"default ps series",
+			"survey",
+		],
+	},
+	"vendors": {
+		"Philips": {
+			"contains": [
+				"RECON",
+			],
+			"exact": [
+				"IN",
+				"OP",
+				"WATER",
+				"ALL",
+				"A1",
+				"A2",
+				"A60",
+				"V60",
+				"3min",
+				"8min",
+			],
+		},
+		"GE": {
+			"contains": [
+				"ORIG",
+				"MPR",
+				"Refomate",
+				"IDEAL IQ",
+			],
+			"exact": [
 				"Ax LAVA-xv 5",
 				"Ax LAVA-xv 10",
 				"Ax LAVA-xv 15",
@@ -146,7 +912,6 @@ def filter_in(x: dict):
 				"WATER: IDEAL IQ (20sec BH)",
 				"FAT: IDEAL IQ (20sec BH)",
 				"OutPhase: IDEAL IQ (20sec BH)",
-
 				"Ax fs DWI MULTI-b",
 				" Ax fs DWI MULTI-b",
 				"lava 4 min",
@@ -158,22 +923,13 @@ def filter_in(x: dict):
 				"Ax LAVA-xv 5  120min",
 				"Ax LAVA-xv 10  120min",
 				"Ax LAVA-xv 15  120min",
-			]
-		)
-	):
-		return False
-	if "SIEMENS" in x["Manufacturer"] and (
-		any(  # 有的序列描述中包含以下关键字
-			[
-				i in x["SeriesDescription"]
-				for i in [
-					"Map",
-				]
-			]
-		)
-		or any(  # 有的序列描述中等于以下关键字
-			i == x["SeriesDescription"]
-			for i in [
+			],
+		},
+		"SIEMENS": {
+			"contains": [
+				"Map",
+			],
+			"exact": [
 				"t1_vibe-twist_dixon_tra_p4_bh_pre_TTC=3.4s_F",
 				"t1_vibe-twist_dixon_tra_p4_bh_art_5phases_TTC=7.7s_F",
 				"t1_vibe-twist_dixon_tra_p4_bh_art_5phases_TTC=10.6s_F",
@@ -191,11 +947,112 @@ def filter_in(x: dict):
 				"vibe_q-dixon_tra_p4_bh_WF",
 				"vibe_q-dixon_tra_p4_bh_W",
 				"vibe_q-dixon_tra_p4_bh_F",
-			]
+			],
+		},
+	},
+}
+
+FILTER_RULES_FILE = "filter_rules.json"
+
+
+def load_filter_rules(rules=None):
+	"""rules 为 None 时返回默认规则, 为字符串时按 JSON 文件读取"""
+	if rules is None:
+		return DEFAULT_FILTER_RULES
+	if isinstance(rules, str):
+		with open(rules, "r", encoding="utf-8") as f:
+			rules = json.load(f)
+	unknown = set(rules) - {"common", "vendors"}
+	if unknown:
+		raise ValueError(f"Unknown filter rule sections: {sorted(unknown)}")
+	return rules
+
+
+def _compile_contains(patterns):
+	if not patterns:
+		return None
+	# 长的关键字在前, 合并为一个正则只扫描一次
+	patterns = sorted(set(patterns), key=len, reverse=True)
+	return re.compile("|".join(re.escape(x) for x in patterns))
+
+
+class _RuleSet:
+	__slots__ = ("exact", "exact_lower", "contains")
+
+	def __init__(self, rules):
+		unknown = set(rules) - {"exact", "exact_lower", "contains"}
+		if unknown:
+			raise ValueError(f"Unknown filter rule keys: {sorted(unknown)}")
+		self.exact = frozenset(rules.get("exact", ()))
+		self.exact_lower = frozenset(x.lower() for x in rules.get("exact_lower", ()))
+		self.contains = _compile_contains(rules.get("contains", ()))
+
+	def match(self, desc, desc_lower):
+		return (
+			desc in self.exact
+			or desc_lower in self.exact_lower
+			or (self.contains is not None and self.contains.search(desc) is not None)
 		)
-	):
-		return False
-	return True
+
+
+class SeriesFilter:
+	"""
+	编译后的序列过滤规则, 返回 True 表示保留
+	rules: dict 或 JSON 文件路径, 格式同 DEFAULT_FILTER_RULES
+	skip_desc / skip_keys: skip_keys 中任一字段的值在 skip_desc 中时过滤
+	同一序列的切片元数据相同, 结果按 (SeriesDescription, Manufacturer, skip_keys 的值) 缓存
+	"""
+
+	def __init__(self, rules=None, skip_desc=(), skip_keys=()):
+		rules = load_filter_rules(rules)
+		self.common = _RuleSet(rules.get("common", {}))
+		self.vendors = [
+			(vendor, _RuleSet(vendor_rules))
+			for vendor, vendor_rules in rules.get("vendors", {}).items()
+		]
+		self.skip_desc = frozenset(skip_desc)
+		self.skip_keys = tuple(skip_keys)
+		self._results = {}
+
+	def evaluate(self, desc, manufacturer, skip_values=()):
+		if any(x in self.skip_desc for x in skip_values):
+			return False
+		desc_lower = desc.lower()
+		if self.common.match(desc, desc_lower):
+			return False
+		for vendor, rule_set in self.vendors:
+			if vendor in manufacturer and rule_set.match(desc, desc_lower):
+				return False
+		return True
+
+	def accept(self, x: dict):
+		key = (
+			x["SeriesDescription"],
+			x["Manufacturer"],
+			tuple(x[k] for k in self.skip_keys),
+		)
+		try:
+			return self._results[key]
+		except KeyError:
+			pass
+		except TypeError:  # 不可哈希的值 (如多值字段) 不缓存
+			return self.evaluate(*key)
+		result = self._results[key] = self.evaluate(*key)
+		return result
+
+	def __call__(self, metadata_list):
+		return [x for x in metadata_list if self.accept(x)]
+
+
+DEFAULT_SERIES_FILTER = SeriesFilter()
+
+
+def filter_in(x: dict):
+	"""
+	根据序列描述和厂商信息过滤序列 (默认规则, 保留以兼容旧代码)
+	x: dict
+	"""
+	return DEFAULT_SERIES_FILTER.accept(x)
 
 
 def sanitize_file_name(file_name):
@@ -204,20 +1061,450 @@ def sanitize_file_name(file_name):
 	return sanitized_file_name
 
 
-class DicomSeriesSplit:
-	@logger.catch
-	def __init__(
-		self,
-		timeout=4,
-		n_jobs=4,
-		backend=None,
-		min_slices=24,
-		skip_desc=None,
-		filter_func=None,
-		meta_keys=None,
-		will_save_file_keys=None,
-		will_save_folder_keys=None,
-		will_save_root_path=None,
+class JobCancelled(Exception):
+	pass
+
+
+class Progress:
+	"""
+	线程安全的进度计数器 (files_scanned, files_read, series_found, series_exported, bytes_written 等)
+	逐个文件的事件只计数, 每 interval 秒最多输出一条 info 日志
+	"""
+
+	def __init__(self, interval=2.0):
+		self.interval = interval
+		self.counts = Counter()
+		self.lock = threading.Lock()
+		self.start_time = time.monotonic()
+		self._last_log = self.start_time
+		self.phase = None
+		self.phase_start = self.start_time
+
+	def set_phase(self, phase):
+		"""当前阶段: scanning (两阶段读取的第一阶段), reading, splitting, exporting"""
+		with self.lock:
+			self.phase = phase
+			self.phase_start = time.monotonic()
+
+	def add(self, key, n=1):
+		with self.lock:
+			self.counts[key] += n
+		self.maybe_log()
+
+	def set(self, key, value):
+		with self.lock:
+			self.counts[key] = value
+		self.maybe_log()
+
+	def counted(self, key, iterable):
+		for item in iterable:
+			self.add(key)
+			yield item
+
+	def snapshot(self):
+		with self.lock:
+			return dict(self.counts)
+
+	def maybe_log(self, force=False):
+		now = time.monotonic()
+		with self.lock:
+			if not force and now - self._last_log < self.interval:
+				return
+			self._last_log = now
+			counts = dict(self.counts)
+		elapsed = now - self.start_time
+		rate = counts.get("files_read", 0) / elapsed if elapsed else 0.0
+		logger.info(
+			f"Progress: {', '.join(f'{k}={v}' for k, v in counts.items())} ({rate:.1f} files/s)"
+		)
+
+
+class StageProfiler:
+	"""
+	按阶段统计: wall/CPU 时间, 处理数量, 字节数, 单项耗时的 p50/p99
+	CPU 时间只包括当前进程 (含线程), 进程池中的耗时体现在单项耗时中
+	cprofile 为 True 时阶段内同时用 cProfile 记录
+	"""
+
+	def __init__(self, cprofile=False):
+		self.stages = {}
+		self.profile = cProfile.Profile() if cprofile else None
+
+	def _stage(self, name):
+		if name not in self.stages:
+			self.stages[name] = {
+				"wall": 0.0,
+				"cpu": 0.0,
+				"items": 0,
+				"bytes": 0,
+				"latencies": array("d"),
+			}
+		return self.stages[name]
+
+	@contextmanager
+	def stage(self, name):
+		stage = self._stage(name)
+		wall, cpu = time.perf_counter(), time.process_time()
+		if self.profile is not None:
+			self.profile.enable()
+		try:
+			yield stage
+		finally:
+			if self.profile is not None:
+				self.profile.disable()
+			stage["wall"] += time.perf_counter() - wall
+			stage["cpu"] += time.process_time() - cpu
+
+	def add(self, name, seconds=None, nbytes=0, items=1):
+		"""记录 items 个处理项, seconds 为单项耗时"""
+		stage = self._stage(name)
+		stage["items"] += items
+		stage["bytes"] += nbytes
+		if seconds is not None:
+			stage["latencies"].append(seconds)
+
+	def timed(self, name, iterable):
+		"""统计消费 iterable 时等待每一项的时间 (如边遍历边读取时的遍历耗时)"""
+		stage = self._stage(name)
+		iterator = iter(iterable)
+		while True:
+			start = time.perf_counter()
+			try:
+				item = next(iterator)
+			except StopIteration:
+				stage["wall"] += time.perf_counter() - start
+				return
+			stage["wall"] += time.perf_counter() - start
+			stage["items"] += 1
+			yield item
+
+	def report(self):
+		stages = {}
+		for name, stage in self.stages.items():
+			latencies = np.frombuffer(stage["latencies"], dtype=np.float64)
+			busy = float(latencies.sum())
+			# 没有阶段计时时 (在进程池中完成的阶段) 按单项耗时之和计算速度
+			seconds = stage["wall"] or busy
+			report = {
+				"wall_s": round(stage["wall"], 3),
+				"cpu_s": round(stage["cpu"], 3),
+				"busy_s": round(busy, 3),
+				"items": stage["items"],
+				"items_per_s": round(stage["items"] / seconds, 1) if seconds else 0.0,
+				"mb": round(stage["bytes"] / 1024**2, 2),
+				"mb_per_s": round(stage["bytes"] / 1024**2 / seconds, 2) if seconds else 0.0,
+			}
+			if len(latencies):
+				p50, p99 = np.percentile(latencies, [50, 99])
+				report.update(p50_ms=round(p50 * 1000, 2), p99_ms=round(p99 * 1000, 2))
+			stages[name] = report
+		return {"version": _version, "stages": stages}
+
+	def summary(self):
+		"""每个阶段一行的文字汇总"""
+		lines = []
+		for name, x in self.report()["stages"].items():
+			line = (
+				f"{name:<12} wall {x['wall_s']:.2f}s cpu {x['cpu_s']:.2f}s "
+				f"{x['items']} items {x['items_per_s']}/s {x['mb_per_s']} MB/s"
+			)
+			if "p50_ms" in x:
+				line += f" p50 {x['p50_ms']}ms p99 {x['p99_ms']}ms"
+			lines.append(line)
+		return "\n".join(lines)
+
+	def write(self, report_file):
+		"""保存 JSON 报告, 启用 cProfile 时同时保存同名的 .prof 文件"""
+		with open(report_file, "w") as f:
+			json.dump(self.report(), f, indent=2)
+		if self.profile is not None:
+			self.profile.dump_stats(os.path.splitext(report_file)[0] + ".prof")
+
+
+def merge_stage_reports(reports):
+	"""合并多次运行的阶段报告 (时间, 数量和字节数相加, 不合并分位数)"""
+	merged = {}
+	for report in reports:
+		for name, x in report.items():
+			stage = merged.setdefault(
+				name, {"wall_s": 0.0, "cpu_s": 0.0, "busy_s": 0.0, "items": 0, "mb": 0.0}
+			)
+			for key in stage:
+				stage[key] = round(stage[key] + x[key], 3)
+	for stage in merged.values():
+		seconds = stage["wall_s"] or stage["busy_s"]
+		stage["items_per_s"] = round(stage["items"] / seconds, 1) if seconds else 0.0
+		stage["mb_per_s"] = round(stage["mb"] / seconds, 2) if seconds else 0.0
+	return merged
+
+
+class MetadataCache:
+	"""
+	元数据持久化缓存 (SQLite)
+	以 (path, size, mtime_ns, meta_keys hash) 为键, 文件未变化时直接返回上次读取的元数据
+	"""
+
+	cache_file_name = ".dicom_splitter_cache.sqlite"
+
+	def __init__(self, cache_file, meta_keys):
+		self.cache_file = cache_file
+		self.keys_hash = hashlib.sha1(
+			json.dumps(sorted(meta_keys)).encode("utf-8")
+		).hexdigest()
+		self.conn = sqlite3.connect(cache_file, timeout=60)
+		self.conn.execute(
+			"CREATE TABLE IF NOT EXISTS metadata ("
+			"path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+			"keys_hash TEXT, metadata BLOB)"
+		)
+		self.conn.commit()
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		self._pending = []
+
+	def __repr__(self):
+		return f"MetadataCache(cache_file={self.cache_file}, {self.stats()})"
+
+	@staticmethod
+	def signature(path):
+		"""返回文件的 (size, mtime_ns), 文件不存在时返回 None"""
+		try:
+			st = os.stat(path)
+		except OSError:
+			return None
+		return st.st_size, st.st_mtime_ns
+
+	def get(self, path, signature):
+		"""命中返回缓存的元数据, 未命中或已失效返回 None"""
+		row = self.conn.execute(
+			"SELECT size, mtime_ns, keys_hash, metadata FROM metadata WHERE path = ?",
+			(path,),
+		).fetchone()
+		if row is None:
+			self.misses += 1
+			return None
+		if signature is None or (row[0], row[1]) != signature or row[2] != self.keys_hash:
+			self.invalidations += 1
+			return None
+		try:
+			metadata = self.loads(row[3])
+		except Exception as e:
+			# 无法解析的条目 (旧版本或其他进程写入的类实例等) 视为未命中, 重新读取后覆盖
+			logger.debug(f"Invalid cache entry of {path}: {e}")
+			self.misses += 1
+			return None
+		self.hits += 1
+		return metadata
+
+	@staticmethod
+	def dumps(metadata):
+		"""
+		以 JSON 保存 [键, 路径, 值], 不使用 pickle: 缓存位于共享的保存目录, 读取时不能执行任意代码
+		值已由 native_value 转换为原生类型, 无法表示为 JSON 时抛出 TypeError
+		"""
+		if isinstance(metadata, dict):
+			metadata = SliceRecord.from_dict(metadata)
+		return json.dumps(
+			[list(metadata._index), metadata.file_path, metadata.values],
+			ensure_ascii=False,
+		)
+
+	@staticmethod
+	def loads(data):
+		"""JSON 的数组由 SliceRecord 转换回 tuple"""
+		keys, file_path, values = json.loads(data)
+		return SliceRecord(keys, file_path, values)
+
+	def put(self, path, signature, metadata):
+		if signature is None or metadata is None:
+			return
+		try:
+			data = self.dumps(metadata)
+		except (TypeError, ValueError) as e:
+			logger.debug(f"Skip caching {path}: {e}")
+			return
+		self._pending.append(
+			(path, signature[0], signature[1], self.keys_hash, data)
+		)
+		if len(self._pending) >= 1000:
+			self.flush()
+
+	def flush(self):
+		if self._pending:
+			self.conn.executemany(
+				"INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+				self._pending,
+			)
+			self.conn.commit()
+			self._pending = []
+
+	def stats(self):
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"invalidations": self.invalidations,
+		}
+
+	def prune(self):
+		"""删除源文件已不存在或已变化的缓存, 返回删除条数"""
+		self.flush()
+		stale = [
+			(path,)
+			for path, size, mtime_ns in self.conn.execute(
+				"SELECT path, size, mtime_ns FROM metadata"
+			).fetchall()
+			if self.signature(path) != (size, mtime_ns)
+		]
+		self.conn.executemany("DELETE FROM metadata WHERE path = ?", stale)
+		self.conn.commit()
+		logger.info(f"Prune {len(stale)} stale entries from {self.cache_file}.")
+		return len(stale)
+
+	def clear(self):
+		self._pending = []
+		self.conn.execute("DELETE FROM metadata")
+		self.conn.commit()
+		self.conn.execute("VACUUM")
+
+	def count(self):
+		return self.conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+
+	def close(self):
+		self.flush()
+		self.conn.close()
+
+
+def _mixed_sort_key(value):
+	if isinstance(value, (int, float)):
+		return (0, value, "")
+	return (1, 0, str(value))
+
+
+def factorize(values, sort=True):
+	"""
+	把一列值编码为整数, 返回 (codes, uniques)
+	sort=True 时编码顺序与值的大小顺序一致, 否则按首次出现的顺序
+	"""
+	uniques = list(dict.fromkeys(values))
+	if sort:
+		try:
+			uniques.sort()
+		except TypeError:  # 不同序列的同一列可能混有数值和字符串 (如 "[NA]")
+			uniques.sort(key=_mixed_sort_key)
+	mapping = {v: i for i, v in enumerate(uniques)}
+	codes = np.fromiter(
+		(mapping[v] for v in values), dtype=np.int64, count=len(values)
+	)
+	return codes, uniques
+
+
+SPLIT_MODES = ("location", "geometry")
+GEOMETRY_KEYS = ["ImagePositionPatient", "ImageOrientationPatient"]
+
+
+def has_geometry(metadata):
+	"""ImagePositionPatient 和 ImageOrientationPatient 是否完整 (3 个和 6 个值, native_value 已转换为 float)"""
+	position = metadata.get("ImagePositionPatient")
+	orientation = metadata.get("ImageOrientationPatient")
+	return (
+		type(position) is tuple
+		and type(orientation) is tuple
+		and len(position) == 3
+		and len(orientation) == 6
+	)
+
+
+class MetadataTable:
+	"""按列保存元数据, 每列编码为整数后做向量化的排序和分组"""
+
+	def __init__(self, rows, record_index=False):
+		self.rows = rows
+		self._columns = {}
+		self._record_index = record_index
+
+	def __len__(self):
+		return len(self.rows)
+
+	def record_index(self):
+		"""行都是键相同的 SliceRecord 时返回共用的键索引, 否则返回 None"""
+		if self._record_index is False:
+			rows = self.rows
+			index = getattr(rows[0], "_index", None) if rows else None
+			if index is not None and not all(
+				type(row) is SliceRecord and row._index is index for row in rows
+			):
+				index = None
+			self._record_index = index
+		return self._record_index
+
+	def column(self, key):
+		"""一列的值; 行都是键相同的 SliceRecord 时直接按位置取值"""
+		index = self.record_index()
+		if index is not None and key in index:
+			i = index[key]
+			return [row.values[i] for row in self.rows]
+		return [row[key] for row in self.rows]
+
+	def codes(self, key, sort=True):
+		if (key, sort) not in self._columns:
+			self._columns[key, sort] = factorize(self.column(key), sort=sort)
+		return self._columns[key, sort]
+
+	def argsort(self, key):
+		return np.argsort(self.codes(key)[0], kind="stable")
+
+	def take(self, index):
+		"""按 index 重排行, 已编码的列一起重排"""
+		table = MetadataTable([self.rows[i] for i in index], self._record_index)
+		for column, (codes, uniques) in self._columns.items():
+			if column[1]:
+				table._columns[column] = (codes[index], uniques)
+		return table
+
+	@staticmethod
+	def groups(codes):
+		"""按编码分组, 返回每组的行号 (组内保持原顺序)"""
+		order = np.argsort(codes, kind="stable")
+		counts = np.bincount(codes)
+		return np.split(order, np.cumsum(counts)[:-1])
+
+
+class DicomSeriesSplit:
+	def __init__(
+		self,
+		timeout=4,
+		n_jobs=4,
+		backend=None,
+		walk_jobs=1,
+		min_slices=24,
+		skip_desc=None,
+		filter_func=None,
+		meta_keys=None,
+		will_save_file_keys=None,
+		will_save_folder_keys=None,
+		will_save_root_path=None,
+		fast_metadata=False,
+		sniff=True,
+		cache=False,
+		cache_file=None,
+		output_format="nii.gz",
+		compression_level=-1,
+		gzip_jobs=1,
+		pixel_reader="itk",
+		stream_threshold=None,
+		single_pass=False,
+		memory_budget=2 * 1024**3,
+		filter_rules=None,
+		prune=False,
+		manifest=False,
+		manifest_file=None,
+		profile=False,
+		split_mode="location",
+		geometry_tolerance=0.01,
+		prefetch=0,
+		prefetch_bytes=64 * 1024,
+		opener=None,
 	):
 		_meta_keys = [
 			"PatientID",
@@ -252,10 +1539,55 @@ class DicomSeriesSplit:
 		):
 			raise ValueError("will_save_root_path must be defined in advance")
 
+		if pixel_reader not in PIXEL_READERS:
+			raise ValueError(
+				f"pixel_reader must be one of {PIXEL_READERS}, got {pixel_reader}"
+			)
+
+		if output_format not in OUTPUT_FORMATS:
+			raise ValueError(
+				f"output_format must be one of {OUTPUT_FORMATS}, got {output_format}"
+			)
+
+		if split_mode not in SPLIT_MODES:
+			raise ValueError(
+				f"split_mode must be one of {SPLIT_MODES}, got {split_mode}"
+			)
+		if split_mode == "geometry":
+			meta_keys = list(dict.fromkeys([*meta_keys, *GEOMETRY_KEYS]))
+
 		self.timeout = timeout
 		self.n_jobs = n_jobs
 		self.backend = backend
+		self.walk_jobs = walk_jobs
+		self.fast_metadata = fast_metadata
+		self.sniff = sniff
+		self.prefetch = prefetch
+		self.prefetch_bytes = prefetch_bytes
+		self.opener = opener
+		self.output_format = output_format
+		self.compression_level = compression_level
+		self.gzip_jobs = gzip_jobs
+		self.pixel_reader = pixel_reader
+		self.stream_threshold = stream_threshold
+		self.single_pass = single_pass
+		self.memory_budget = memory_budget
+		self.cache = cache
+		self.cache_file = cache_file or os.path.join(
+			will_save_root_path, MetadataCache.cache_file_name
+		)
+		self.manifest = manifest
+		self.manifest_file = manifest_file or os.path.join(
+			will_save_root_path, ExportManifest.manifest_file_name
+		)
+		self.source_path = None
+		self.profile = profile
+		self.profiler = StageProfiler(profile)
+		self.progress = Progress()
+		self.checkpoint = None  # 由 SplitJob 设置, 暂停时阻塞, 取消时抛出 JobCancelled
 		self.min_slices = min_slices
+		self.split_mode = split_mode
+		self.geometry_tolerance = geometry_tolerance
 		self.meta_keys = meta_keys
 		self.will_save_file_keys = will_save_file_keys
 		self.will_save_folder_keys = will_save_folder_keys
@@ -274,337 +1606,2082 @@ class DicomSeriesSplit:
 		else:
 			self.skip_desc = skip_desc
 
-		self.filter_func = filter_func
+		self.filter_func = filter_func
+		self.series_filter = SeriesFilter(
+			filter_rules, self.skip_desc, self.will_save_file_keys
+		)
+		self.prune = prune
+		# 两阶段读取时第一阶段的字段: 分组, 过滤和 extract_metadata 需要的字段
+		self.prune_keys = list(
+			dict.fromkeys(
+				[
+					"SeriesInstanceUID",
+					"SeriesDescription",
+					"Manufacturer",
+					"AccessionNumber",
+					"StudyID",
+					"SliceLocation",
+					"AcquisitionTime",
+					*self.will_save_file_keys,
+					*(GEOMETRY_KEYS if split_mode == "geometry" else []),
+				]
+			)
+		)
+
+		logger.info(f"Create {self.__repr__()}")
+
+	def __repr__(self):
+		return (
+			f"DicomSplitter(will_save_file_keys={self.will_save_file_keys} "
+			f"will_save_folder_keys={self.will_save_folder_keys} "
+			f"will_save_root_path={self.will_save_root_path}"
+		)
+
+	def open_cache(self):
+		return MetadataCache(self.cache_file, self.meta_keys)
+
+	def check(self):
+		if self.checkpoint is not None:
+			self.checkpoint()
+
+	def make_prefetcher(self):
+		"""prefetch > 0 时为一次读取创建预读层, 在途读取数从较小值开始按延迟调整, 上限为 prefetch"""
+		if not self.prefetch:
+			return None
+		return Prefetcher(
+			self.prefetch, self.prefetch_bytes, opener=self.opener or open
+		)
+
+	def has_location(self, metadata):
+		"""切片能否排序: location 模式需要 SliceLocation, geometry 模式需要 ImagePositionPatient 和 ImageOrientationPatient"""
+		if self.split_mode == "geometry":
+			return has_geometry(metadata)
+		return metadata["SliceLocation"] != "[NA]"
+
+	def keep_slice(self, metadata):
+		"""单次读取模式下判断切片是否可能被保留, 一定会被过滤的切片立即丢弃像素"""
+		if not self.has_location(metadata) or metadata["AcquisitionTime"] == "[NA]":
+			return False
+		if self.filter_func:
+			return True
+		return self.series_filter.accept(metadata)
+
+	def read_metadata(self, dicom_files, cache=None, slices=None, partial=None):
+		"""
+		读取 dicom_files (可以是生成器) 的元数据, 返回元数据列表 (读取失败为 None)
+		cache: MetadataCache, 命中的文件不再读取, 直接加入结果
+		slices: dict, 单次读取模式下保存 {file: SliceData}, 超过 memory_budget 时清空并回退为两次读取
+		partial: prune_files 返回的 {file: 第一阶段的元数据}, 给出时只读取缺少的字段并合并,
+			第一阶段已经检查过文件头和缓存, 不再重复
+		"""
+		metadata_list = []
+		meta_keys = self.meta_keys
+		if partial is not None:
+			# extract_metadata 需要检查号和 AcquisitionTime
+			meta_keys = list(
+				dict.fromkeys(
+					[
+						"AccessionNumber",
+						"StudyID",
+						"AcquisitionTime",
+						*(k for k in self.meta_keys if k not in self.prune_keys),
+					]
+				)
+			)
+		signatures = {}
+		total = [0]
+		rejected = 0
+		slice_bytes = 0
+		prefetcher = self.make_prefetcher()
+		with_pixels = threading.Event()
+		if slices is not None:
+			with_pixels.set()
+
+		def files_to_read():
+			for file in dicom_files:
+				self.check()
+				total[0] += 1
+				if cache is not None:
+					signature = cache.signature(file)
+					metadata = None if partial is not None else cache.get(file, signature)
+					if metadata is not None:
+						metadata_list.append(metadata)
+						self.progress.add("files_cached")
+						continue
+					signatures[file] = signature
+				yield file
+
+		for i, (file, metadata, slice_data, seconds) in enumerate(
+			read_metadata_list(
+				files_to_read(),
+				meta_keys,
+				n_jobs=self.n_jobs,
+				backend=self.backend,
+				fast=self.fast_metadata,
+				sniff=self.sniff and partial is None,
+				with_pixels=with_pixels,
+				opener=self.opener,
+				prefetch=prefetcher,
+			)
+		):
+			self.profiler.add("metadata", seconds)
+			if metadata == NOT_DICOM:
+				rejected += 1
+				signatures.pop(file, None)
+				continue
+			if partial is not None and metadata is not None:
+				first = partial.pop(file)
+				metadata = SliceRecord(
+					self.meta_keys,
+					file,
+					[first[k] if k in first else metadata[k] for k in self.meta_keys],
+				)
+			metadata_list.append(metadata)
+			if cache is not None:
+				cache.put(file, signatures.pop(file), metadata)
+			if (
+				slice_data is not None
+				and with_pixels.is_set()
+				and self.keep_slice(metadata)
+			):
+				slice_bytes += slice_data.pixels.nbytes
+				if slice_bytes > self.memory_budget:
+					logger.warning(
+						f"Pixel data exceeds memory budget {self.memory_budget} bytes, fallback to two-pass mode."
+					)
+					with_pixels.clear()
+					slices.clear()
+				else:
+					slices[file] = slice_data
+			self.progress.add("files_read")
+			logger.debug(f"Read {i + 1} DICOM files. Success.")
+
+		logger.info(f"Get {total[0]} files, reject {rejected} non-DICOM files.")
+		if prefetcher is not None:
+			logger.info(
+				f"Prefetch {prefetcher.limit} outstanding reads, "
+				f"max {max(prefetcher.limits, default=prefetcher.limit)}."
+			)
+		if cache is not None:
+			cache.flush()
+			logger.info(f"{cache}")
+
+		return metadata_list
+
+	def prune_files(self, dicom_files, cache=None):
+		"""
+		两阶段读取的第一阶段: 只读取分组和过滤需要的字段
+		返回 (需要继续读取的文件, {file: 第一阶段的元数据}, 命中缓存的完整元数据)
+		被过滤的切片和切片数不超过 min_slices 的序列不再读取, 保留的切片在第二阶段只补充缺少的字段
+		"""
+		records = []
+		cached_ids = set()
+		total = 0
+		prefetcher = self.make_prefetcher()
+
+		def files_to_read():
+			nonlocal total
+			for file in dicom_files:
+				self.check()
+				total += 1
+				if cache is not None:  # 命中缓存的文件已有完整元数据
+					metadata = cache.get(file, cache.signature(file))
+					if metadata is not None:
+						records.append(metadata)
+						cached_ids.add(id(metadata))
+						continue
+				yield file
+
+		for file, metadata, _, seconds in read_metadata_list(
+			files_to_read(),
+			self.prune_keys,
+			n_jobs=self.n_jobs,
+			backend=self.backend,
+			fast=True,
+			sniff=self.sniff,
+			opener=self.opener,
+			prefetch=prefetcher,
+		):
+			self.profiler.add("prune", seconds)
+			self.progress.add("files_prechecked")
+			if metadata is not None and metadata != NOT_DICOM:
+				records.append(metadata)
+
+		# 与 __call__ 中的切片过滤相同, 剩余切片数即为分组后的序列长度
+		valid = len(records)
+		records = [x for x in records if self.keep_slice(x)]
+		counts = Counter(x["SeriesInstanceUID"] for x in records)
+		records = [x for x in records if counts[x["SeriesInstanceUID"]] > self.min_slices]
+		partial = {}
+		cached = []
+		for x in records:
+			if id(x) in cached_ids:
+				cached.append(x)
+			else:
+				partial[x["file_path"]] = x
+		self.progress.set("files_total", len(records))
+		self.progress.set("slices_pruned", valid - len(records))
+		self.progress.add("files_cached", len(cached))
+		logger.info(
+			f"Prune {total - len(records)} of {total} files, "
+			f"{sum(x > self.min_slices for x in counts.values())} of {len(counts)} series left."
+		)
+		return list(partial), partial, cached
+
+	def rebuild_cache(self, _path):
+		"""清空缓存并重新读取 _path 下所有文件的元数据"""
+		cache = self.open_cache()
+		try:
+			cache.clear()
+			dicom_files = get_dicom_file(_path, timeout=self.timeout)
+			self.read_metadata(dicom_files, cache)
+			return cache.count()
+		finally:
+			cache.close()
+
+	def export(self, split_list=None, max_memory=None, retries=1):
+		"""
+		并行保存 __call__ 返回的序列, 返回每个序列的结果报告
+		启用 manifest 时只保存新增或变化的序列 (状态为 unchanged 的序列未重新保存), 并删除过期的输出
+		"""
+		if split_list is None:
+			split_list = self.split_list
+		manifest = (
+			ExportManifest(self.manifest_file, self.will_save_root_path)
+			if self.manifest
+			else None
+		)
+		self.progress.set_phase("exporting")
+		with self.profiler.stage("export"):
+			pending = split_list if manifest is None else manifest.plan(split_list)
+			results = export_series(
+				pending,
+				n_jobs=self.n_jobs,
+				backend=self.backend,
+				max_memory=max_memory,
+				retries=retries,
+				on_result=self.on_export_result,
+				checkpoint=self.checkpoint,
+			)
+			if manifest is not None:
+				results = manifest.update(split_list, results, self.source_path)
+		self.profiler.add("export", items=len(results))
+		for result in results:
+			if result.get("read_seconds") is not None:
+				self.profiler.add(
+					"read_pixels", result["read_seconds"], result["pixel_bytes"]
+				)
+			if result.get("write_seconds") is not None:
+				self.profiler.add("write", result["write_seconds"], result["bytes"])
+		logger.info(f"Export {len(results)} series: {summarize_export(results)}")
+		for series_data in split_list:
+			series_data.slices = None
+		return results
+
+	def on_export_result(self, result):
+		self.progress.add("series_exported")
+		if result["status"] == "saved":
+			self.progress.add("bytes_written", result["bytes"])
+
+	def series_folder(self, metadata, first_file):
+		"""由 PatientID / AccessionNumber 生成保存目录, 两者都为空时按 StudyID 区分"""
+		# 1.3 sanitize_file_name will_save_folder
+		patient_id = (
+			metadata["PatientID"]
+			if metadata["PatientID"] != ""
+			else "NonePatientID"
+		)
+		accession_number = (
+			metadata["AccessionNumber"]
+			if metadata["AccessionNumber"] != ""
+			else "NoneAccessionNumber"
+		)
+		study_id = (
+			metadata["StudyID"] if metadata["StudyID"] != "" else "NoneStudyID"
+		)
+
+		patient_id = sanitize_file_name(patient_id)
+		accession_number = sanitize_file_name(accession_number)
+		study_id = sanitize_file_name(study_id)
+
+		if (
+			patient_id == "NonePatientID"
+			and accession_number == "NoneAccessionNumber"
+		):
+			logger.warning(
+				f"PatientID and AccessionNumber are [NA] in {first_file} !!!, will skip."
+			)
+			return f"NonePatientID/NoneAccessionNumber/{study_id}"
+		return "/".join([patient_id, accession_number])
+
+	def geometry_locations(self, value, orientation_codes, projections, slice_locations):
+		"""
+		geometry 模式的位置编码: 按方向编码分组 (按首次出现的顺序), 每组内把 ImagePositionPatient 在法向量上的投影排序,
+		相邻投影相差不超过 geometry_tolerance (mm) 的归为同一位置
+		orientation_codes / projections / slice_locations: 与 value 对应的数组, SliceLocation 缺少时为 nan
+		返回 [(行号, 位置编码)]; SliceLocation 完整时编码方向与 SliceLocation 一致, 与 location 模式的结果相同
+		"""
+		if np.all(orientation_codes == orientation_codes[0]):
+			masks = [slice(None)]
+		else:
+			uniques, first = np.unique(orientation_codes, return_index=True)
+			masks = [orientation_codes == uniques[o] for o in np.argsort(first)]
+
+		parts = []
+		for mask in masks:
+			part_projections = projections[mask]
+			order = np.argsort(part_projections, kind="stable")
+			gaps = np.diff(part_projections[order]) > self.geometry_tolerance
+			codes = np.empty(len(order), dtype=np.int64)
+			codes[order] = np.concatenate([[0], np.cumsum(gaps)])
+
+			part_locations = slice_locations[mask]
+			if not np.isnan(part_locations).any():
+				covariance = np.dot(
+					part_projections - part_projections.mean(),
+					part_locations - part_locations.mean(),
+				)
+				if covariance < 0:
+					codes = codes.max() - codes
+			parts.append((value[mask], codes))
+		return parts
+
+	def split_series(self, table):
+		"""
+		按 SeriesInstanceUID 分组, 再按 AcquisitionNumber 或位置拆分为多个序列
+		位置: location 模式为 SliceLocation, geometry 模式为 geometry_locations 的编码 (多个方向时每个方向单独拆分)
+		table: MetadataTable, 分组和排序都在整数编码上完成
+		序列按保存目录 (PatientID / AccessionNumber) 分为检查, 每个检查独立拆分并从 0 编号,
+		检查内按序列的最早 AcquisitionTime, 再按 SeriesInstanceUID 排序, 编号与其他检查和处理顺序无关
+		"""
+		if len(table) == 0:  # 所有切片都被过滤 (如只有定位像的检查)
+			return []
+		table = table.take(table.argsort("AcquisitionTime"))
+		time_codes, _ = table.codes("AcquisitionTime")
+		series_codes, series_uids = table.codes("SeriesInstanceUID", sort=False)
+		if self.split_mode == "location":
+			location_codes, _ = table.codes("SliceLocation")
+		else:
+			# 每个切片的位置只投影一次: ImagePositionPatient 点乘层面法向量
+			positions = np.fromiter(
+				chain.from_iterable(table.column("ImagePositionPatient")),
+				dtype=np.float64,
+				count=len(table) * 3,
+			).reshape(-1, 3)
+			orientations = np.fromiter(
+				chain.from_iterable(table.column("ImageOrientationPatient")),
+				dtype=np.float64,
+				count=len(table) * 6,
+			).reshape(-1, 6)
+			projections = np.einsum(
+				"ij,ij->i",
+				positions,
+				np.cross(orientations[:, :3], orientations[:, 3:]),
+			)
+			rounded = np.round(orientations, 4)
+			if np.all(rounded == rounded[0]):
+				orientation_codes = np.zeros(len(table), dtype=np.int64)
+			else:
+				_, orientation_codes = np.unique(rounded, axis=0, return_inverse=True)
+				orientation_codes = orientation_codes.reshape(-1)
+			slice_locations = np.array(
+				[
+					x if isinstance(x, (int, float)) else np.nan
+					for x in table.column("SliceLocation")
+				],
+				dtype=np.float64,
+			)
+		aq_codes, aq_uniques = table.codes("AcquisitionNumber")
+		instance_codes, _ = table.codes("InstanceNumber")
+
+		def split_group(key, value, locations, file_name):
+			"""
+			返回 [(行号, will_save_file)]
+			value: 一个序列 (或一个方向) 的行号, locations: 对应的位置编码
+			geometry 模式下, 多期相序列中缺少 SliceLocation 的切片 (location 模式会丢弃) 只有与其他切片位置相同时才保留,
+			避免个别多余的切片改变拆分方式; 整个序列都缺少 SliceLocation 时全部保留
+			"""
+			order = np.lexsort((instance_codes[value], locations))
+			value, locations = value[order], locations[order]
+
+			if self.split_mode == "geometry":
+				no_location = np.isnan(slice_locations[value])
+				location_uniques, location_counts = np.unique(
+					locations, return_counts=True
+				)
+				if no_location.any() and not no_location.all() and location_counts.max() > 1:
+					single = location_counts[np.searchsorted(location_uniques, locations)] == 1
+					keep = ~(no_location & single)
+					if not keep.all():
+						logger.info(
+							f"Group {key} drop {int((~keep).sum())} slices without SliceLocation at single-slice positions."
+						)
+						value, locations = value[keep], locations[keep]
+
+			aq_number_uniques, aq_counts = np.unique(
+				aq_codes[value], return_counts=True
+			)
+			location_uniques, location_counts = np.unique(
+				locations, return_counts=True
+			)
+
+			if len(aq_number_uniques) == 1:
+				use_aq_number = False
+			elif (
+				len(value) % len(location_uniques) == 0
+				and len(value) % len(aq_number_uniques) == 0
+			):
+				use_aq_number = False
+			elif len(value) % len(aq_number_uniques) == 0:
+				use_aq_number = bool(
+					np.all(aq_counts == len(value) // len(aq_number_uniques))
+				)
+			else:
+				use_aq_number = False
+
+			if use_aq_number:  # 多序列拆分 使用AcquisitionNumber
+				logger.info(
+					f"Use AcquisitionNumber Will Split {len(aq_number_uniques)} Series."
+				)
+
+				# 每个 AcquisitionNumber 的切片数相同, 稳定排序后等分即可
+				grouped = value[np.argsort(aq_codes[value], kind="stable")]
+				return [
+					(aq_rows, f"{file_name}-{aq_uniques[aq_code]}")
+					for aq_code, aq_rows in zip(
+						aq_number_uniques, np.split(grouped, len(aq_number_uniques))
+					)
+				]
+			else:  # 当AcquisitionNumber都相同时，尝试使用SliceLocation拆分
+				if not len(location_uniques) == len(value):
+					location_drop = location_counts == 1
+					keep = ~location_drop[
+						np.searchsorted(location_uniques, locations)
+					]
+					value = value[keep]
+					location_uniques = location_uniques[~location_drop]
+					location_counts = location_counts[~location_drop]
+					logger.info(
+						f"Group {key} has {len(value)} slices, but only {len(value)} unique locations. Will Drop {int(location_drop.sum())} locations."
+					)
+
+				# value 已按位置排序, 同一位置的切片连续存放
+				location_starts = np.cumsum(location_counts) - location_counts
+
+				split_num = len(value) // len(location_uniques)
+
+				logger.info(f"Use SliceLocation Will Split {split_num} Series.")
+
+				parts = []
+				for i in range(split_num):
+					if np.any(location_counts <= i):
+						# 与逐个取值时相同, 某个位置的切片不足时报错
+						raise IndexError(
+							f"Group {key} has not enough slices at every location for series {i}."
+						)
+					parts.append((value[location_starts + i], f"{file_name}-{i}"))
+				return parts
+
+		def split_one(key, value):
+			"""拆分一个 SeriesInstanceUID 分组, 返回 [(行号, will_save_file)]"""
+			file_name_s = [
+				sanitize_file_name(table.rows[value[0]][key])
+				for key in self.will_save_file_keys
+			]
+			file_name = "-".join(
+				[x if len(x) != 0 else "None" for x in file_name_s]
+			)
+
+			if self.split_mode == "location":
+				return split_group(key, value, location_codes[value], file_name)
+
+			parts = self.geometry_locations(
+				value,
+				orientation_codes[value],
+				projections[value],
+				slice_locations[value],
+			)
+			if len(parts) == 1:
+				return split_group(key, *parts[0], file_name)
+			logger.info(f"Group {key} has {len(parts)} orientations.")
+			split_parts = []
+			for i, (rows, locations) in enumerate(parts):
+				if len(rows) <= self.min_slices:
+					logger.info(
+						f"Group {key} orientation {i} has {len(rows)} slices, less than {self.min_slices}. Skip."
+					)
+				else:
+					split_parts += split_group(key, rows, locations, f"{file_name}-O{i}")
+			return split_parts
+
+		def split_study(will_save_folder, series):
+			"""拆分一个检查的全部序列, 编号只取决于检查内序列的排序"""
+			series.sort(key=lambda x: (time_codes[x[1][0]], x[0]))
+			split_list = []
+			for key, value in series:
+				for rows, will_save_file in split_one(key, value):
+					series_data = SeriesData(
+						index=len(split_list),
+						files=FileList.from_records([table.rows[r] for r in rows]),
+						will_save_file=will_save_file,
+						will_save_folder=will_save_folder,
+						will_save_root_path=self.will_save_root_path,
+						output_format=self.output_format,
+						compression_level=self.compression_level,
+						gzip_jobs=self.gzip_jobs,
+						pixel_reader=self.pixel_reader,
+						stream_threshold=self.stream_threshold,
+					)
+					logger.info(f"Create {series_data} successfully.")
+					split_list.append(series_data)
+			return split_list
+
+		# 每个序列内部按 AcquisitionTime 排列, 保存目录由序列的第一个切片决定
+		studies = {}
+		for key, value in zip(series_uids, table.groups(series_codes)):
+			if len(value) <= self.min_slices:
+				logger.info(
+					f"Group {key} has {len(value)} slices, less than {self.min_slices}. Skip."
+				)
+				continue
+			first = table.rows[value[0]]
+			will_save_folder = self.series_folder(first, first["file_path"])
+			studies.setdefault(will_save_folder, []).append((key, value))
+
+		# 检查之间互不影响, 结果按保存目录排序
+		return list(
+			chain.from_iterable(split_study(*x) for x in sorted(studies.items()))
+		)
+
+	@logger.catch(exclude=JobCancelled)
+	def __call__(self, _path):
+		self.source_path = _path
+		self.profiler = StageProfiler(self.profile)
+		self.progress = Progress()
+		# 遍历与读取同时进行, walk 只统计读取时等待遍历的时间
+		dicom_files = self.progress.counted(
+			"files_scanned",
+			self.profiler.timed(
+				"walk",
+				iter_dicom_file(_path, timeout=self.timeout, n_jobs=self.walk_jobs),
+			),
+		)
+
+		cache = self.open_cache() if self.cache else None
+		slices = {} if self.single_pass else None
+		partial = None
+		cached = []
+		try:
+			# 自定义 filter_func 可能依赖任意字段, 此时不能提前剪枝
+			if self.prune and not self.filter_func:
+				self.progress.set_phase("scanning")
+				with self.profiler.stage("prune"):
+					dicom_files, partial, cached = self.prune_files(dicom_files, cache)
+			self.progress.set_phase("reading")
+			with self.profiler.stage("metadata"):
+				metadata_list = cached + self.read_metadata(
+					dicom_files, cache, slices, partial
+				)
+		finally:
+			if cache is not None:
+				cache.close()
+
+		self.progress.set_phase("splitting")
+		with self.profiler.stage("split"):
+			split_list = self.split_metadata(metadata_list, _path)
+		self.profiler.add("split", items=len(split_list))
+		self.progress.set("series_found", len(split_list))
+		self.progress.maybe_log(force=True)
+
+		if slices:  # 单次读取模式: 只保留最终序列用到的像素
+			for series_data in split_list:
+				series_data.slices = {
+					f: slices[f] for f in series_data.files if f in slices
+				}
+
+		self.split_list = split_list
+		return split_list
+
+	def split_metadata(self, metadata_list, _path):
+		"""过滤元数据列表并拆分为 SeriesData 列表"""
+		metadata_list = list(filter(lambda x: x is not None, metadata_list))
+
+		# 两阶段读取时切片可能全部在第一阶段被过滤, 与不剪枝时一样返回空列表
+		if len(metadata_list) == 0 and not self.progress.counts["slices_pruned"]:
+			raise ValueError(f"No valid metadata found in {_path}")
+
+		# 遍历和缓存命中的顺序不固定, 按路径排序保证每次结果一致
+		metadata_list.sort(key=lambda x: x["file_path"])
+
+		logger.info(
+			f"Get {len(metadata_list)} DICOM files with valid metadata."
+		)
+
+		metadata_list = list(
+			filter(
+				lambda x: self.has_location(x) and x["AcquisitionTime"] != "[NA]",
+				metadata_list,
+			)
+		)
+
+		if self.filter_func:
+			metadata_list = self.filter_func(metadata_list)
+		else:
+			metadata_list = self.series_filter(metadata_list)
+
+		return self.split_series(MetadataTable(metadata_list))
+
+
+OUTPUT_FORMATS = ("nii.gz", "nii", "nrrd", "mha")
+PIXEL_READERS = ("itk", "pydicom")
+
+
+def _rescale(ds):
+	slope = ds.get("RescaleSlope", 1)
+	intercept = ds.get("RescaleIntercept", 0)
+	return (
+		1.0 if slope in (None, "") else float(slope),
+		0.0 if intercept in (None, "") else float(intercept),
+	)
+
+
+def _stored_dtype(ds):
+	return np.dtype(
+		f"{'<i' if ds.PixelRepresentation else '<u'}{ds.BitsAllocated // 8}"
+	)
+
+
+def _rescaled_dtype(ds):
+	"""
+	与 GDCMImageIO 一致的输出类型: 没有 rescale 时为存储类型;
+	slope / intercept 都是整数时为能容纳重缩放后取值范围的最小整数类型, 否则为 float64
+	"""
+	slope, intercept = _rescale(ds)
+	if slope == 1 and intercept == 0:
+		return _stored_dtype(ds)
+	if slope != int(slope) or intercept != int(intercept):
+		return np.dtype(np.float64)
+
+	bits_stored = ds.get("BitsStored", ds.BitsAllocated)
+	if ds.PixelRepresentation:
+		stored_min, stored_max = -(2 ** (bits_stored - 1)), 2 ** (bits_stored - 1) - 1
+	else:
+		stored_min, stored_max = 0, 2**bits_stored - 1
+	low, high = sorted(
+		(slope * stored_min + intercept, slope * stored_max + intercept)
+	)
+	for dtype in (
+		(np.uint8, np.uint16, np.uint32)
+		if low >= 0
+		else (np.int8, np.int16, np.int32)
+	):
+		info = np.iinfo(dtype)
+		if info.min <= low and high <= info.max:
+			return np.dtype(dtype)
+	return np.dtype(np.float64)
+
+
+def _read_pixels_into(ds, out):
+	"""把 ds 的像素 (已 rescale) 写入 out, 未压缩且无需转换时直接从 PixelData 拷贝"""
+	slope, intercept = _rescale(ds)
+	transfer_syntax = ds.file_meta.get("TransferSyntaxUID")
+	stored_dtype = _stored_dtype(ds)
+	if (
+		transfer_syntax in (ImplicitVRLittleEndian, ExplicitVRLittleEndian)
+		and slope == 1
+		and intercept == 0
+		and stored_dtype == out.dtype
+		and (
+			ds.PixelRepresentation == 0
+			or ds.get("BitsStored", ds.BitsAllocated) == ds.BitsAllocated
+		)
+	):
+		out[...] = np.frombuffer(
+			ds.PixelData, dtype=stored_dtype, count=out.size
+		).reshape(out.shape)
+	elif slope == 1 and intercept == 0:
+		out[...] = ds.pixel_array
+	else:
+		out[...] = ds.pixel_array * slope + intercept
+
+
+@dataclass
+class SliceData:
+	"""单个切片已 rescale 的像素和几何信息"""
+
+	pixels: np.ndarray
+	position: tuple
+	orientation: tuple
+	pixel_spacing: tuple
+
+
+def _check_slice(ds):
+	if int(ds.get("NumberOfFrames", 1) or 1) > 1:
+		raise NotImplementedError("Multi-frame file")
+	if ds.get("SamplesPerPixel", 1) != 1:
+		raise NotImplementedError("Color image")
+	if not all(
+		k in ds
+		for k in ("ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing")
+	):
+		raise NotImplementedError("Missing geometry")
+
+
+def _slice_geometry(ds):
+	return (
+		tuple(float(x) for x in ds.ImagePositionPatient),
+		tuple(float(x) for x in ds.ImageOrientationPatient),
+		tuple(float(x) for x in ds.PixelSpacing),
+	)
+
+
+def read_slice(ds):
+	"""把已完整读取的 Dataset 转换为 SliceData"""
+	_check_slice(ds)
+	pixels = np.empty((ds.Rows, ds.Columns), dtype=_rescaled_dtype(ds))
+	_read_pixels_into(ds, pixels)
+	return SliceData(pixels, *_slice_geometry(ds))
+
+
+def read_volume(dicom_files, slices=None):
+	"""
+	按 dicom_files 的顺序组装体数据, 写入预分配的数组后一次性转换为 SimpleITK 图像
+	slices: {file: SliceData}, 已在内存中的切片不再读取; 其余文件用 pydicom 读取 (每个文件只打开一次)
+	几何信息与 ImageSeriesReader 一致: 原点为第一个文件的 ImagePositionPatient,
+	方向由 ImageOrientationPatient 及其法向量组成, 层间距为首尾两个文件的距离 / (n - 1)
+	多帧、彩色或缺少几何信息时抛出 NotImplementedError
+	"""
+	if len(dicom_files) < 2:
+		raise NotImplementedError("Need at least 2 files")
+	slices = slices or {}
+
+	volume = None
+	for i, file in enumerate(dicom_files):
+		slice_data = slices.get(file)
+		if slice_data is None:
+			ds = pydicom.dcmread(file, force=True)
+			_check_slice(ds)
+			shape, dtype = (ds.Rows, ds.Columns), _rescaled_dtype(ds)
+			geometry = _slice_geometry(ds)
+		else:
+			shape, dtype = slice_data.pixels.shape, slice_data.pixels.dtype
+			geometry = (
+				slice_data.position,
+				slice_data.orientation,
+				slice_data.pixel_spacing,
+			)
+
+		if volume is None:
+			volume = np.empty((len(dicom_files), *shape), dtype=dtype)
+			first_geometry = geometry
+		elif shape != volume.shape[1:]:
+			raise NotImplementedError(f"Size of {file} is different")
+
+		if slice_data is None:
+			_read_pixels_into(ds, volume[i])
+		else:
+			volume[i] = slice_data.pixels
+		last_geometry = geometry
+
+	image = sitk.GetImageFromArray(volume)
+	_set_geometry(image, first_geometry, last_geometry, len(dicom_files))
+	return image
+
+
+def _set_geometry(image, first_geometry, last_geometry, n):
+	"""由首尾两个切片的几何信息设置 image 的原点, 间距和方向 (与 ImageSeriesReader 一致)"""
+	first_position, orientation, pixel_spacing = (
+		np.array(x, dtype=np.float64) for x in first_geometry
+	)
+	last_position = np.array(last_geometry[0], dtype=np.float64)
+	slice_spacing = np.linalg.norm(last_position - first_position) / (n - 1)
+	if slice_spacing == 0:
+		raise NotImplementedError("Slices at the same position")
+
+	row, col = orientation[:3], orientation[3:]
+	direction = np.stack([row, col, np.cross(row, col)], axis=1)
+
+	image.SetOrigin(tuple(first_position))
+	image.SetSpacing((pixel_spacing[1], pixel_spacing[0], slice_spacing))
+	image.SetDirection(tuple(direction.flatten()))
+
+
+def gzip_file(src_file, dst_file, compression_level=-1, n_jobs=1, block_size=16 * 1024**2):
+	"""
+	gzip 压缩 src_file 到 dst_file
+	n_jobs > 1 时按 block_size 分块并行压缩, 拼接为多成员 gzip 文件 (gzip 标准格式, 解压结果与单成员一致)
+	"""
+	with open(src_file, "rb") as fin, open(dst_file, "wb") as fout:
+		blocks = iter(lambda: fin.read(block_size), b"")
+		write_gzip_blocks(fout, blocks, compression_level, n_jobs)
+
+
+def write_gzip_blocks(fout, blocks, compression_level=-1, n_jobs=1):
+	"""
+	把 blocks 中的每个块压缩为一个 gzip 成员写入 fout
+	n_jobs > 1 时并行压缩, 最多 n_jobs * 2 个块在途, 此时 blocks 不能复用同一块内存
+	"""
+	compression_level = 6 if compression_level < 0 else compression_level
+
+	def compress(block):
+		return gzip.compress(block, compresslevel=compression_level, mtime=0)
+
+	n_jobs = get_n_jobs(n_jobs)
+	if n_jobs == 1:
+		for block in blocks:
+			fout.write(compress(block))
+		return
+
+	with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+		futures = deque()
+		for block in blocks:
+			futures.append(executor.submit(compress, block))
+			if len(futures) >= n_jobs * 2:  # 限制在途块数
+				fout.write(futures.popleft().result())
+		while futures:
+			fout.write(futures.popleft().result())
+
+
+def write_image(image, save_file, output_format="nii.gz", compression_level=-1, gzip_jobs=1):
+	"""
+	按 output_format 保存图像
+	nii.gz: 默认设置下由 SimpleITK 压缩; 指定 compression_level 或 gzip_jobs > 1 时
+		先写出 .nii 再用 gzip_file 压缩 (NiftiImageIO 不支持设置压缩级别)
+	nii: 不压缩
+	nrrd / mha: compression_level 为 0 时不压缩, 否则使用 SimpleITK 的 zlib 压缩
+	"""
+	if output_format == "nii":
+		sitk.WriteImage(image, save_file, False)
+	elif output_format == "nii.gz":
+		if compression_level < 0 and gzip_jobs == 1:
+			sitk.WriteImage(image, save_file, True)
+			return
+		temp_file = save_file[: -len(".gz")]
+		try:
+			sitk.WriteImage(image, temp_file, False)
+			gzip_file(temp_file, save_file, compression_level, gzip_jobs)
+		finally:
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
+	else:
+		sitk.WriteImage(
+			image, save_file, compression_level != 0, compression_level
+		)
+
+
+def nifti_header(shape, dtype, first_geometry, last_geometry, work_file):
+	"""
+	返回与 SimpleITK 写出的 .nii 相同的文件头 (含扩展和填充, 长度为 vox_offset)
+	先把同几何信息, 同像素类型的 1x1x1 图像写入 work_file (LPS 到 RAS 的转换, qform / sform 由 ITK 完成),
+	再把 dim 改为 shape (Z, Y, X); 其余字段与图像大小无关
+	"""
+	image = sitk.GetImageFromArray(np.zeros((1, 1, 1), dtype=dtype))
+	_set_geometry(image, first_geometry, last_geometry, shape[0])
+	try:
+		sitk.WriteImage(image, work_file, False)
+		with open(work_file, "rb") as f:
+			header = bytearray(f.read(348))
+			vox_offset = int(struct.unpack_from("<f", header, 108)[0])
+			header += f.read(vox_offset - len(header))
+	finally:
+		if os.path.exists(work_file):
+			os.remove(work_file)
+	struct.pack_into("<3h", header, 42, shape[2], shape[1], shape[0])
+	return bytes(header)
+
+
+def write_nifti_stream(
+	dicom_files,
+	save_file,
+	output_format="nii.gz",
+	compression_level=-1,
+	gzip_jobs=1,
+	slices=None,
+	slab_bytes=32 * 1024**2,
+	timings=None,
+):
+	"""
+	按 dicom_files 的顺序逐块 (每块约 slab_bytes) 读取切片并写入 .nii / .nii.gz, 不组装整个体数据
+	峰值内存约为 slab_bytes (gzip_jobs > 1 时分给在途的 gzip_jobs * 2 块), 与序列大小无关
+	体素和几何信息与 read_volume 一致, 文件头与 SimpleITK 写出的相同; nii.gz 为多成员 gzip
+	slices: {file: SliceData}, 已在内存中的切片不再读取
+	多帧、彩色、缺少几何信息或切片大小不一致时抛出 NotImplementedError, 此时 save_file 不完整, 由调用方删除
+	"""
+	if output_format not in ("nii", "nii.gz"):
+		raise NotImplementedError(f"Stream writing {output_format}")
+	if len(dicom_files) < 2:
+		raise NotImplementedError("Need at least 2 files")
+	slices = slices or {}
+	timings = {} if timings is None else timings
+	start = time.perf_counter()
+
+	def geometry(file, stop_before_pixels):
+		slice_data = slices.get(file)
+		if slice_data is not None:
+			pixels = slice_data.pixels
+			return None, pixels.shape, pixels.dtype, (
+				slice_data.position,
+				slice_data.orientation,
+				slice_data.pixel_spacing,
+			)
+		ds = pydicom.dcmread(file, force=True, stop_before_pixels=stop_before_pixels)
+		_check_slice(ds)
+		return ds, (ds.Rows, ds.Columns), _rescaled_dtype(ds), _slice_geometry(ds)
+
+	first_ds, shape, dtype, first_geometry = geometry(dicom_files[0], False)
+	_, _, _, last_geometry = geometry(dicom_files[-1], True)
+	header = nifti_header(
+		(len(dicom_files), *shape),
+		dtype,
+		first_geometry,
+		last_geometry,
+		save_file + ".header.nii",
+	)
+
+	n_jobs = 1 if output_format == "nii" else get_n_jobs(gzip_jobs)
+	if n_jobs > 1:
+		slab_bytes //= n_jobs * 2
+	slab_slices = max(1, slab_bytes // (shape[0] * shape[1] * dtype.itemsize))
+	slab = np.empty((min(slab_slices, len(dicom_files)), *shape), dtype=dtype)
+	read_seconds = 0.0
+
+	def blocks():
+		nonlocal first_ds, read_seconds
+		yield header
+		for offset in range(0, len(dicom_files), slab_slices):
+			read_start = time.perf_counter()
+			chunk = dicom_files[offset : offset + slab_slices]
+			for i, file in enumerate(chunk):
+				slice_data = slices.get(file)
+				if slice_data is not None:
+					if slice_data.pixels.shape != shape:
+						raise NotImplementedError(f"Size of {file} is different")
+					slab[i] = slice_data.pixels
+					continue
+				if first_ds is not None:
+					ds, first_ds = first_ds, None
+				else:
+					ds = pydicom.dcmread(file, force=True)
+					_check_slice(ds)
+				if (ds.Rows, ds.Columns) != shape:
+					raise NotImplementedError(f"Size of {file} is different")
+				_read_pixels_into(ds, slab[i])
+			read_seconds += time.perf_counter() - read_start
+			# 并行压缩时块在途, 不能复用 slab
+			yield slab[: len(chunk)].tobytes() if n_jobs > 1 else slab[: len(chunk)]
+
+	with open(save_file, "wb") as fout:
+		if output_format == "nii":
+			for block in blocks():
+				fout.write(block)
+		else:
+			write_gzip_blocks(fout, blocks(), compression_level, n_jobs)
+
+	timings["read_seconds"] = read_seconds
+	timings["write_seconds"] = time.perf_counter() - start - read_seconds
+	timings["pixel_bytes"] = len(dicom_files) * shape[0] * shape[1] * dtype.itemsize
+	return save_file
+
+
+@dataclass
+class SeriesData:
+	index: int
+	files: list
+	will_save_file: str
+	will_save_folder: str
+	will_save_root_path: str
+	output_format: str = "nii.gz"
+	compression_level: int = -1
+	gzip_jobs: int = 1
+	pixel_reader: str = "itk"
+	stream_threshold: int = None
+	overwrite: bool = False
+	slices: dict = field(default=None, repr=False, compare=False)
+
+	def __repr__(self):
+		return f"SeriesData(index={self.index}, will_save_file={self.will_save_file}, files_length={len(self.files)})"
+
+	@logger.catch
+	def to_itk(self):
+		if self.slices or self.pixel_reader == "pydicom":
+			try:
+				return read_volume(self.files, self.slices)
+			except NotImplementedError as e:
+				logger.info(f"{self}: {e}, use ImageSeriesReader.")
+
+		reader = sitk.ImageSeriesReader()
+		reader.SetFileNames(list(self.files))
+		image = reader.Execute()
+
+		return image
+
+	def get_save_file(self):
+		return os.path.join(
+			self.will_save_root_path,
+			self.will_save_folder,
+			f"{self.index:02d}-L{len(self.files):03d}-{self.will_save_file}.{self.output_format}",
+		)
+
+	def estimate_bytes(self):
+		"""以源文件大小之和估计体数据占用的内存"""
+		size = 0
+		for file in self.files:
+			try:
+				size += os.path.getsize(file)
+			except OSError:
+				pass
+		return size
+
+	def save_nifti(self, timings=None):
+		"""
+		按 output_format 保存, 失败时抛出异常
+		先写入临时文件再重命名, 中断时不会留下不完整的文件
+		返回保存的文件路径, 文件已存在 (且 overwrite 为 False) 时返回 None
+		timings: dict, 记录读取像素和写入的耗时 (read_seconds, write_seconds) 和像素字节数
+		"""
+		timings = {} if timings is None else timings
+		save_file = self.get_save_file()
+		os.makedirs(os.path.dirname(save_file), exist_ok=True)
+
+		if os.path.exists(save_file) and not self.overwrite:
+			logger.info(f"File {save_file} already exists. Skip.")
+			return None
+
+		temp_file = os.path.join(
+			os.path.dirname(save_file), "." + os.path.basename(save_file)
+		)
+		try:
+			if not self.save_stream(temp_file, timings):
+				self.save_image(temp_file, timings)
+			os.replace(temp_file, save_file)
+		finally:
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
+		logger.info(f"Save file {save_file} successfully.")
+		return save_file
+
+	def save_stream(self, save_file, timings):
+		"""
+		估计大小不小于 stream_threshold 的 nii / nii.gz 序列逐块写入, 不组装整个体数据
+		不适用或不支持时返回 False
+		"""
+		if (
+			self.stream_threshold is None
+			or self.output_format not in ("nii", "nii.gz")
+			or self.estimate_bytes() < self.stream_threshold
+		):
+			return False
+		try:
+			write_nifti_stream(
+				self.files,
+				save_file,
+				self.output_format,
+				self.compression_level,
+				self.gzip_jobs,
+				slices=self.slices,
+				timings=timings,
+			)
+		except NotImplementedError as e:
+			logger.info(f"{self}: {e}, write the whole volume.")
+			return False
+		self.slices = None
+		return True
+
+	def save_image(self, save_file, timings):
+		start = time.perf_counter()
+		image = self.to_itk()
+		self.slices = None  # 像素已复制到 image 中
+		if image is None:
+			raise RuntimeError(f"Error in reading {self}")
+		timings["read_seconds"] = time.perf_counter() - start
+		timings["pixel_bytes"] = (
+			image.GetNumberOfPixels()
+			* image.GetNumberOfComponentsPerPixel()
+			* image.GetSizeOfPixelComponent()
+		)
+
+		start = time.perf_counter()
+		write_image(
+			image,
+			save_file,
+			self.output_format,
+			self.compression_level,
+			self.gzip_jobs,
+		)
+		timings["write_seconds"] = time.perf_counter() - start
+
+	@logger.catch
+	def to_save_nifti(self):
+		return self.save_nifti()
+
+
+def export_series_data(series_data, retries=1):
+	"""保存单个序列, 失败时重试 retries 次, 返回结果报告"""
+	result = {
+		"series": repr(series_data),
+		"file": series_data.get_save_file(),
+		"status": "failed",
+		"attempts": 0,
+		"bytes": 0,
+		"seconds": 0.0,
+		"error": None,
+		"read_seconds": None,
+		"write_seconds": None,
+		"pixel_bytes": 0,
+	}
+	start = time.perf_counter()
+	for attempt in range(retries + 1):
+		result["attempts"] = attempt + 1
+		try:
+			save_file = series_data.save_nifti(result)
+		except Exception as e:
+			result["error"] = f"{type(e).__name__}: {e}"
+			logger.warning(
+				f"Error in saving {series_data} (attempt {attempt + 1}/{retries + 1}). Error: {e}"
+			)
+			continue
+		result["status"] = "skipped" if save_file is None else "saved"
+		result["bytes"] = os.path.getsize(result["file"])
+		result["error"] = None
+		break
+	result["seconds"] = round(time.perf_counter() - start, 3)
+	return result
+
+
+def export_series(
+	split_list,
+	n_jobs=1,
+	backend=None,
+	max_memory=None,
+	retries=1,
+	on_result=None,
+	checkpoint=None,
+):
+	"""
+	并行保存 split_list 中的序列, 返回与 split_list 顺序一致的结果报告
+	max_memory: 同时处理的序列的估计内存上限 (字节), 超过上限时等待已提交的序列完成
+	on_result: 每个序列完成时在调用线程中以结果报告调用
+	checkpoint: 提交每个序列前调用, 可以阻塞 (暂停) 或抛出异常 (取消), 已提交的序列会保存完
+	"""
+	on_result = on_result or (lambda result: None)
+	checkpoint = checkpoint or (lambda: None)
+	n_jobs = get_n_jobs(n_jobs)
+	if n_jobs == 1:
+		results = []
+		for series_data in split_list:
+			checkpoint()
+			results.append(export_series_data(series_data, retries))
+			on_result(results[-1])
+		return results
+
+	results = [None] * len(split_list)
+	with get_executor(n_jobs, backend) as executor:
+		running = {}
+		in_flight = 0
+		for i, series_data in enumerate(split_list):
+			checkpoint()
+			size = series_data.estimate_bytes() if max_memory else 0
+			# 单个序列超过上限时单独处理
+			while running and (
+				len(running) >= n_jobs * 2
+				or (max_memory and in_flight + size > max_memory)
+			):
+				finished, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in finished:
+					j, j_size = running.pop(future)
+					results[j] = future.result()
+					on_result(results[j])
+					in_flight -= j_size
+			future = executor.submit(export_series_data, series_data, retries)
+			running[future] = (i, size)
+			in_flight += size
+
+		for future in as_completed(running):
+			j, _ = running[future]
+			results[j] = future.result()
+			on_result(results[j])
+
+	return results
+
+
+def summarize_export(results):
+	summary = Counter(x["status"] for x in results)
+	summary["bytes"] = sum(x["bytes"] for x in results)
+	return dict(summary)
+
+
+class ExportManifest:
+	"""
+	保存在输出目录下的清单: 输出文件 -> 源文件列表和源文件签名的哈希
+	重新运行时只保存新增或变化的序列, 并删除源目录下已过期的输出
+	"""
+
+	manifest_file_name = ".dicom_splitter_manifest.json"
+
+	def __init__(self, manifest_file, root_path):
+		self.manifest_file = manifest_file
+		self.root_path = root_path
+		self.outputs = {}
+		self._hashes = {}
+		if os.path.exists(manifest_file):
+			with open(manifest_file, "r", encoding="utf-8") as f:
+				self.outputs = json.load(f).get("outputs", {})
+
+	def key(self, series_data):
+		return os.path.relpath(series_data.get_save_file(), self.root_path).replace(
+			os.sep, "/"
+		)
+
+	@staticmethod
+	def source_hash(series_data):
+		"""按顺序对源文件的路径, 大小和修改时间计算哈希"""
+		h = hashlib.sha1()
+		for file in series_data.files:
+			h.update(f"{file}\0{MetadataCache.signature(file)}\n".encode())
+		return h.hexdigest()
+
+	def plan(self, split_list):
+		"""
+		返回需要保存的序列
+		输出已存在且哈希不变 (或清单中没有记录的旧输出) 时跳过, 哈希变化时覆盖保存
+		"""
+		pending = []
+		for series_data in split_list:
+			key = self.key(series_data)
+			digest = self._hashes[key] = self.source_hash(series_data)
+			entry = self.outputs.get(key)
+			if os.path.exists(series_data.get_save_file()):
+				if entry is None or entry["hash"] == digest:
+					continue
+				series_data.overwrite = True
+			pending.append(series_data)
+		return pending
+
+	@staticmethod
+	def is_under(source_path, file):
+		"""file 是否在 source_path 下, 不同盘符 (commonpath 抛出 ValueError) 视为不在"""
+		try:
+			return os.path.commonpath([source_path, os.path.abspath(file)]) == source_path
+		except ValueError:
+			return False
+
+	def update(self, split_list, results, source_path=None):
+		"""
+		记录保存结果并删除过期的输出, 返回与 split_list 顺序一致的结果报告
+		results: plan 返回的序列的结果报告
+		source_path: 本次处理的 DICOM 目录, 只删除源文件都在该目录下的过期输出;
+			为 None 时不知道本次处理的范围, 不删除任何输出
+		"""
+		results = {x["file"]: x for x in results}
+		reports = []
+		keys = set()
+		for series_data in split_list:
+			key = self.key(series_data)
+			keys.add(key)
+			save_file = series_data.get_save_file()
+			result = results.get(save_file)
+			if result is None:
+				result = {
+					"series": repr(series_data),
+					"file": save_file,
+					"status": "unchanged",
+					"attempts": 0,
+					"bytes": os.path.getsize(save_file),
+					"seconds": 0.0,
+					"error": None,
+				}
+			reports.append(result)
+			if result["status"] != "failed":  # 失败时保留旧记录, 下次重试
+				self.outputs[key] = {
+					"files": list(series_data.files),
+					"hash": self._hashes[key],
+				}
+
+		removed = 0
+		source_path = os.path.abspath(source_path) if source_path else None
+		for key in list(self.outputs) if source_path is not None else []:
+			if key in keys:
+				continue
+			files = self.outputs[key]["files"]
+			if not all(self.is_under(source_path, x) for x in files):
+				continue
+			save_file = os.path.join(self.root_path, key)
+			if os.path.exists(save_file):
+				os.remove(save_file)
+				logger.info(f"Remove outdated {save_file}.")
+			del self.outputs[key]
+			removed += 1
+
+		self.save()
+		logger.info(
+			f"Manifest {self.manifest_file}: {len(self.outputs)} outputs, remove {removed} outdated."
+		)
+		return reports
+
+	def save(self):
+		temp_file = self.manifest_file + ".tmp"
+		with open(temp_file, "w", encoding="utf-8") as f:
+			json.dump({"version": _version, "outputs": self.outputs}, f, ensure_ascii=False)
+		os.replace(temp_file, self.manifest_file)
+
+
+def make_splitter(save_path, **kwargs):
+	"""按 GUI 的默认设置创建 DicomSeriesSplit, kwargs 覆盖默认值"""
+	params = dict(
+		timeout=2,
+		n_jobs=8,
+		min_slices=10,
+		meta_keys=APP_META_KEYS,
+		backend="spawn",
+		# will_save_file_keys=["SeriesDescription"],
+		will_save_file_keys=[
+			"SeriesDescription",
+			"ProtocolName",
+			"AcquisitionTime",
+		],
+		will_save_folder_keys=["PatientID", "AccessionNumber"],
+		will_save_root_path=save_path,
+		stream_threshold=1024**3,
+		filter_rules=FILTER_RULES_FILE
+		if os.path.exists(FILTER_RULES_FILE)
+		else None,
+	)
+	params.update(kwargs)
+	return DicomSeriesSplit(**params)
+
+
+def iter_study_dirs(root_path, depth=1):
+	"""按路径顺序返回 root_path 下第 depth 层的子目录 (检查目录), depth 为 0 时返回 root_path"""
+	if depth == 0:
+		yield root_path
+		return
+	try:
+		with os.scandir(root_path) as it:
+			entries = [x.path for x in it if x.is_dir(follow_symlinks=False)]
+	except OSError:
+		return
+	for entry in sorted(entries):
+		yield from iter_study_dirs(entry, depth - 1)
+
+
+def convert_study(study, save_path, profile_dir=None, **split_kwargs):
+	"""
+	拆分并保存一个检查目录, 返回结果记录 (包括各阶段的耗时统计)
+	profile_dir: 保存 cProfile 结果的目录
+	"""
+	start = time.time()
+	record = {
+		"study": study,
+		"status": "failed",
+		"files": 0,
+		"series": {},
+		"bytes": 0,
+		"seconds": 0.0,
+	}
+	split = make_splitter(save_path, profile=profile_dir is not None, **split_kwargs)
+	split_list = split(study)
+	if split_list is not None:
+		results = split.export(split_list)
+		record["status"] = "done"
+		record["files"] = sum(len(x.files) for x in split_list)
+		record["series"] = dict(Counter(x["status"] for x in results))
+		record["bytes"] = sum(x["bytes"] for x in results if x["status"] == "saved")
+	record["seconds"] = round(time.time() - start, 3)
+	record["stages"] = split.profiler.report()["stages"]
+	if profile_dir is not None:
+		name = hashlib.sha1(os.path.abspath(study).encode()).hexdigest()[:12]
+		record["profile"] = os.path.join(profile_dir, f"{name}.prof")
+		split.profiler.profile.dump_stats(record["profile"])
+	return record
+
+
+def _dir_signature(path):
+	"""返回目录下所有文件的 (数量, 总大小, 最新修改时间), 用于轮询时判断目录是否变化"""
+	count, size, mtime = 0, 0, 0
+	stack = [path]
+	while stack:
+		try:
+			with os.scandir(stack.pop()) as it:
+				for entry in it:
+					if entry.is_dir(follow_symlinks=False):
+						stack.append(entry.path)
+					elif entry.is_file():
+						st = entry.stat()
+						count += 1
+						size += st.st_size
+						mtime = max(mtime, st.st_mtime_ns)
+		except OSError:  # 接收过程中目录可能被移动或删除
+			pass
+	return count, size, mtime
+
+
+WATCH_EVENT_TYPES = {"created", "modified", "moved", "deleted", "closed"}
+
+
+class WatchFolder:
+	"""
+	监视接收目录, 检查目录 (input_path 下第 study_depth 层子目录) 在 quiet 秒内没有变化后拆分并保存
+	安装 watchdog 时使用文件系统事件 (Linux 下为 inotify), 否则每 interval 秒轮询一次
+	split_kwargs: 传给 make_splitter 的参数, 默认启用缓存和清单, 重复处理同一检查只保存变化的序列
+	"""
+
+	def __init__(
+		self,
+		input_path,
+		save_path,
+		quiet=10,
+		interval=2,
+		study_depth=1,
+		metrics_file=None,
+		polling=False,
+		**split_kwargs,
+	):
+		self.input_path = os.path.abspath(input_path)
+		self.save_path = save_path
+		self.quiet = quiet
+		self.interval = interval
+		self.study_depth = study_depth
+		self.metrics_file = metrics_file
+		self.polling = polling or Observer is None
+		self.split_kwargs = dict(cache=True, manifest=True)
+		self.split_kwargs.update(split_kwargs)
+
+		self.lock = threading.Lock()
+		self.changed = {}  # study -> 最后一次变化的时间
+		self.signatures = {}  # 轮询模式下每个检查目录的签名
+		self.stop_event = threading.Event()
+		self.start_time = time.time()
+		self.latencies = deque(maxlen=1000)
+		self.counts = Counter()
+		self.stages = {}
 
-		logger.info(f"Create {self.__repr__()}")
+	def study_of(self, path):
+		"""
+		返回 path 所属的检查目录, 不在 study_depth 层以下时返回 None
+		与轮询模式 (iter_study_dirs) 一致, 第 study_depth 层不是目录 (如直接放在接收目录下的文件) 时也返回 None
+		"""
+		rel = os.path.relpath(path, self.input_path)
+		if rel.startswith(os.pardir):
+			return None
+		parts = [] if rel == os.curdir else rel.split(os.sep)
+		if len(parts) < self.study_depth:
+			return None
+		study = os.path.join(self.input_path, *parts[: self.study_depth])
+		if not os.path.isdir(study) or os.path.islink(study):
+			return None
+		return study
 
-	def __repr__(self):
-		return (
-			f"DicomSplitter(will_save_file_keys={self.will_save_file_keys} "
-			f"will_save_folder_keys={self.will_save_folder_keys} "
-			f"will_save_root_path={self.will_save_root_path}"
-		)
+	def iter_studies(self):
+		return iter_study_dirs(self.input_path, self.study_depth)
 
-	@logger.catch
-	def __call__(self, _path):
-		dicom_files = get_dicom_file(_path, timeout=self.timeout)
-		logger.info(f"From {_path} Maybe Get {len(dicom_files)} DICOM files.")
+	def mark(self, path, timestamp=None):
+		study = self.study_of(path)
+		if study is None:
+			return
+		with self.lock:
+			self.changed[study] = timestamp or time.time()
 
-		metadata_list = []
-		for i, file in enumerate(dicom_files):
-			metadata = get_metadata(file, self.meta_keys)
-			metadata_list.append(metadata)
-			logger.info(
-				f"Read {i + 1}/{len(dicom_files)} DICOM files. Success."
+	def poll(self):
+		"""轮询所有检查目录, 签名变化的目录标记为已变化"""
+		now = time.time()
+		for study in self.iter_studies():
+			signature = _dir_signature(study)
+			if self.signatures.get(study) != signature:
+				self.signatures[study] = signature
+				with self.lock:
+					self.changed[study] = now
+
+	def quiescent(self):
+		"""返回已静止 quiet 秒的检查目录 (按变化时间排序) 及其最后变化时间"""
+		now = time.time()
+		with self.lock:
+			ready = sorted(
+				(t, s) for s, t in self.changed.items() if now - t >= self.quiet
 			)
+			for _, study in ready:
+				del self.changed[study]
+		return [(s, t) for t, s in ready]
 
-		metadata_list = list(filter(lambda x: x is not None, metadata_list))
+	def process(self, study, changed_time):
+		logger.info(f"Watch: process {study}.")
+		record = convert_study(study, self.save_path, **self.split_kwargs)
+		self.counts["busy_seconds"] += record["seconds"]
+		if record["status"] != "done":
+			self.counts["studies_failed"] += 1
+			return
+		for status, count in record["series"].items():
+			self.counts[f"series_{status}"] += count
+		self.counts["bytes"] += record["bytes"]
+		self.counts["files"] += record["files"]
+		self.counts["studies_processed"] += 1
+		self.stages = merge_stage_reports([self.stages, record["stages"]])
+		self.latencies.append(time.time() - changed_time)
+		logger.info(f"Watch: {study} done in {record['seconds']:.1f}s, {record['series']}")
 
-		if len(metadata_list) == 0:
-			raise ValueError(f"No valid metadata found in {dicom_files}")
+	def metrics(self):
+		with self.lock:
+			queue_depth = len(self.changed)
+		busy = self.counts["busy_seconds"]
+		latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+		return {
+			"version": _version,
+			"mode": "polling" if self.polling else "events",
+			"uptime_s": round(time.time() - self.start_time, 1),
+			"queue_depth": queue_depth,
+			**{k: v for k, v in self.counts.items() if k != "busy_seconds"},
+			"busy_s": round(busy, 1),
+			"files_per_s": round(self.counts["files"] / busy, 1) if busy else 0.0,
+			"mb_per_s": round(self.counts["bytes"] / 1024**2 / busy, 2) if busy else 0.0,
+			"latency_s": {
+				"p50": round(float(np.percentile(latencies, 50)), 2),
+				"p99": round(float(np.percentile(latencies, 99)), 2),
+				"max": round(float(latencies.max()), 2),
+			},
+			"stages": self.stages,
+		}
 
-		logger.info(
-			f"Get {len(metadata_list)} DICOM files with valid metadata."
-		)
+	def write_metrics(self):
+		if self.metrics_file is None:
+			return
+		temp_file = self.metrics_file + ".tmp"
+		with open(temp_file, "w") as f:
+			json.dump(self.metrics(), f, indent=2)
+		os.replace(temp_file, self.metrics_file)
 
-		metadata_list = list(
-			filter(
-				lambda x: x["SliceLocation"] != "[NA]"
-				and x["AcquisitionTime"] != "[NA]",
-				metadata_list,
-			)
-		)
+	def start_observer(self):
+		watch = self
 
-		if self.filter_func:
-			metadata_list = self.filter_func(metadata_list)
-		else:
-			for key in self.will_save_file_keys:
-				metadata_list = list(
-					filter(
-						lambda x: x[key] not in self.skip_desc, metadata_list
-					)
-				)
-			metadata_list = list(filter(filter_in, metadata_list))
+		class Handler(FileSystemEventHandler):
+			def on_any_event(self, event):
+				# 忽略 opened / closed_no_write, 读取文件本身也会产生这些事件
+				if event.event_type not in WATCH_EVENT_TYPES:
+					return
+				watch.mark(event.src_path)
+				dest_path = getattr(event, "dest_path", None)
+				if dest_path:
+					watch.mark(dest_path)
+
+		observer = Observer()
+		observer.schedule(Handler(), self.input_path, recursive=True)
+		observer.start()
+		return observer
 
-		metadata_list = sorted(
-			metadata_list, key=lambda x: x["AcquisitionTime"]
+	def run(self):
+		"""阻塞运行直到 stop() 被调用"""
+		logger.info(
+			f"Watch {self.input_path} ({'polling' if self.polling else 'events'}), quiet {self.quiet}s."
 		)
+		observer = None if self.polling else self.start_observer()
+		if observer is not None:
+			# 启动前已存在的检查也处理一次, 清单会跳过已保存的序列
+			for study in self.iter_studies():
+				self.mark(study)
+		try:
+			while not self.stop_event.is_set():
+				if observer is None:
+					self.poll()
+				for study, changed_time in self.quiescent():
+					if self.stop_event.is_set():
+						break
+					try:
+						self.process(study, changed_time)
+					except Exception as e:
+						# 单个检查出错 (如写入输出或清单失败) 不停止监视
+						logger.exception(f"Watch: failed to process {study}: {e}")
+						self.counts["studies_failed"] += 1
+				self.write_metrics()
+				self.stop_event.wait(self.interval)
+		finally:
+			if observer is not None:
+				observer.stop()
+				observer.join()
+			self.write_metrics()
+			logger.info(f"Watch stopped: {self.metrics()}")
 
-		series_dict = {}
-		for metadata in metadata_list:
-			series_instance_uid = metadata["SeriesInstanceUID"]
-			if series_instance_uid not in series_dict:
-				series_dict[series_instance_uid] = []
-			series_dict[series_instance_uid].append(metadata)
+	def stop(self):
+		self.stop_event.set()
 
-		split_list = []
-		index = 0
-		will_save_folder_flag = None
-		for key, value in series_dict.items():
-			if len(value) <= self.min_slices:
-				logger.info(
-					f"Group {key} has {len(value)} slices, less than {self.min_slices}. Skip."
-				)
-				continue
 
-			file_name_s = [
-				sanitize_file_name(value[0][key])
-				for key in self.will_save_file_keys
-			]
-			file_name = "-".join(
-				[x if len(x) != 0 else "None" for x in file_name_s]
-			)
+def run_shard(shard, studies, save_path, work_dir, split_kwargs):
+	"""
+	在进程池中依次处理一个分片的检查, 日志写入 shard-XXX.log
+	每完成一个检查就追加一行到 shard-XXX.jsonl, 中断后可以从这里恢复
+	"""
+	logger.remove()
+	log_id = logger.add(os.path.join(work_dir, f"shard-{shard:03d}.log"), level="INFO")
+	records = []
+	try:
+		with open(os.path.join(work_dir, f"shard-{shard:03d}.jsonl"), "a") as f:
+			for study in studies:
+				try:
+					record = convert_study(study, save_path, **split_kwargs)
+				except Exception as e:
+					logger.error(f"Batch: error in {study}. Error: {e}")
+					record = {
+						"study": study,
+						"status": "failed",
+						"files": 0,
+						"series": {},
+						"bytes": 0,
+						"seconds": 0.0,
+						"error": f"{type(e).__name__}: {e}",
+					}
+				record["shard"] = shard
+				f.write(json.dumps(record, ensure_ascii=False) + "\n")
+				f.flush()
+				records.append(record)
+	finally:
+		logger.remove(log_id)
+	return records
 
-			# if file_name == "BH_Ax_3D_DE_IN_OUT-3T_ABD_CARDIAC_5-154502":
-			# 	pass
-			
-			value = sorted(
-				value, key=lambda x: (x["SliceLocation"], x["InstanceNumber"])
-			)
 
-			aq_numbers = [x["AcquisitionNumber"] for x in value]
-			aq_number_uniques = sorted(set(aq_numbers))
+class BatchRunner:
+	"""
+	无界面批量处理: 把检查目录分成 shards 个分片, 在 workers 个进程中处理
+	work_dir 中保存每个分片的日志和状态, 重新运行时跳过已完成的检查, 最后写入 summary.json
+	"""
 
-			slice_locations = [x["SliceLocation"] for x in value]
-			slice_location_uniques = sorted(set(slice_locations))
+	work_dir_name = ".dicom_splitter_batch"
 
-			if len(aq_number_uniques) == 1:
-				use_aq_number = False
-			else:
-				if len(value) % len(slice_location_uniques) == 0 and len(value) % len(aq_number_uniques) == 0:
-					use_aq_number = False
+	def __init__(
+		self,
+		save_path,
+		studies,
+		workers=None,
+		shards=None,
+		work_dir=None,
+		**split_kwargs,
+	):
+		self.save_path = save_path
+		self.studies = list(dict.fromkeys(studies))
+		self.workers = get_n_jobs(workers)
+		# 分片数多于进程数, 处理快的进程可以继续领取分片
+		self.shards = shards or self.workers * 4
+		self.work_dir = work_dir or os.path.join(save_path, self.work_dir_name)
+		self.split_kwargs = split_kwargs
+		os.makedirs(self.work_dir, exist_ok=True)
 
-				elif len(value) % len(aq_number_uniques) == 0:
-					aq_numbers2 = list(aq_number_uniques) * (
-						len(value) // len(aq_number_uniques)
-					)
-					if sorted(aq_numbers2) == sorted(aq_numbers):
-						use_aq_number = True
-					else:
-						use_aq_number = False
+	def load_state(self):
+		"""返回已完成的检查的记录 {study: record}"""
+		done = {}
+		for name in sorted(os.listdir(self.work_dir)):
+			if not (name.startswith("shard-") and name.endswith(".jsonl")):
+				continue
+			with open(os.path.join(self.work_dir, name)) as f:
+				for line in f:
+					try:
+						record = json.loads(line)
+					except ValueError:  # 中断时写了一半的行
+						continue
+					if record["status"] == "done":
+						done[record["study"]] = record
+		return done
 
-				else:
-					use_aq_number = False
+	def summarize(self, records, resumed, seconds):
+		series = Counter()
+		for record in records:
+			series.update(record["series"])
+		failed = [x["study"] for x in records if x["status"] != "done"]
+		return {
+			"version": _version,
+			"save_path": self.save_path,
+			"studies": len(self.studies),
+			"resumed": resumed,
+			"done": sum(x["status"] == "done" for x in records),
+			"failed": len(failed),
+			"files": sum(x["files"] for x in records),
+			"series": dict(series),
+			"bytes": sum(x["bytes"] for x in records),
+			"seconds": round(seconds, 1),
+			"stages": merge_stage_reports(x.get("stages", {}) for x in records),
+			"failed_studies": failed,
+		}
 
-			if use_aq_number:  # 多序列拆分 使用AcquisitionNumber
+	def run(self):
+		start = time.time()
+		done = self.load_state()
+		pending = [x for x in self.studies if x not in done]
+		logger.info(
+			f"Batch: {len(self.studies)} studies, {len(done)} done, {len(pending)} pending, "
+			f"{self.workers} workers. Logs in {self.work_dir}"
+		)
+		shards = [
+			(i, pending[i :: self.shards])
+			for i in range(min(self.shards, len(pending)))
+		]
+		records = [done[x] for x in self.studies if x in done]
+		with get_executor(self.workers, "spawn") as executor:
+			futures = {
+				executor.submit(
+					run_shard, i, studies, self.save_path, self.work_dir, self.split_kwargs
+				): i
+				for i, studies in shards
+			}
+			for future in as_completed(futures):
+				try:
+					shard_records = future.result()
+				except Exception as e:  # 进程崩溃, 已完成的检查已写入状态文件
+					logger.error(f"Batch: shard {futures[future]} failed. Error: {e}")
+					continue
+				records.extend(shard_records)
 				logger.info(
-					f"Use AcquisitionNumber Will Split {len(aq_number_uniques)} Series."
+					f"Batch: shard {futures[future]} finished {len(shard_records)} studies, "
+					f"{len(records)}/{len(self.studies)} in total."
 				)
 
-				for aq_number in aq_number_uniques:
-					aq_value = [
-						x for x in value if x["AcquisitionNumber"] == aq_number
-					]
-
-					sub_files = [x["file_path"] for x in aq_value]
-
-					# 1.3 sanitize_file_name will_save_folder
-					patient_id = (
-						value[0]["PatientID"]
-						if value[0]["PatientID"] != ""
-						else "NonePatientID"
-					)
-					accession_number = (
-						value[0]["AccessionNumber"]
-						if value[0]["AccessionNumber"] != ""
-						else "NoneAccessionNumber"
-					)
-					study_id = (
-						value[0]["StudyID"]
-						if value[0]["StudyID"] != ""
-						else "NoneStudyID"
-					)
-
-					patient_id = sanitize_file_name(patient_id)
-					accession_number = sanitize_file_name(accession_number)
-					study_id = sanitize_file_name(study_id)
+		# 分片崩溃时从状态文件补全已完成的记录, 分片没有处理到的检查记为失败
+		finished = {x["study"] for x in records}
+		records.extend(
+			x for s, x in self.load_state().items() if s not in finished
+		)
+		finished = {x["study"] for x in records}
+		missing = [x for x in pending if x not in finished]
+		if missing:
+			logger.error(f"Batch: {len(missing)} studies were not processed.")
+		records.extend(
+			{
+				"study": study,
+				"status": "failed",
+				"files": 0,
+				"series": {},
+				"bytes": 0,
+				"seconds": 0.0,
+				"error": "shard failed before processing this study",
+			}
+			for study in missing
+		)
+		summary = self.summarize(records, len(done), time.time() - start)
+		with open(os.path.join(self.work_dir, "summary.json"), "w") as f:
+			json.dump(summary, f, indent=2, ensure_ascii=False)
+		return summary
 
-					if (
-						patient_id == "NonePatientID"
-						and accession_number == "NoneAccessionNumber"
-					):
-						logger.warning(
-							f"PatientID and AccessionNumber are [NA] in {sub_files[0]} !!!, will skip."
-						)
-						will_save_folder = (
-							f"NonePatientID/NoneAccessionNumber/{study_id}"
-						)
-					else:
-						will_save_folder = "/".join(
-							[patient_id, accession_number]
-						)
 
-					index = (
-						0
-						if will_save_folder != will_save_folder_flag
-						else index
-					)
-					will_save_folder_flag = will_save_folder
-					series_data = SeriesData(
-						index=index,
-						files=sub_files,
-						will_save_file=f"{file_name}-{aq_number}",
-						will_save_folder=will_save_folder,
-						will_save_root_path=self.will_save_root_path,
-					)
+class WorkQueue:
+	"""
+	保存在共享文件系统上的 SQLite 任务队列, 每个任务是一个检查目录
+	工作进程租用任务并定期续租, 租约过期 (进程崩溃) 的任务可以被其他工作进程重新租用
+	"""
 
-					logger.info(f"Create {series_data} successfully.")
+	def __init__(self, queue_file, max_attempts=3):
+		self.queue_file = queue_file
+		self.max_attempts = max_attempts
+		# 手动管理事务, 租用时用 BEGIN IMMEDIATE 加写锁
+		self.conn = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+		self.conn.execute(
+			"CREATE TABLE IF NOT EXISTS jobs ("
+			"study TEXT PRIMARY KEY, status TEXT, worker TEXT, "
+			"lease_until REAL, attempts INTEGER, record TEXT, updated REAL)"
+		)
 
-					split_list.append(series_data)
-					index += 1
-			else:  # 当AcquisitionNumber都相同时，尝试使用SliceLocation拆分
-				location_value = [x["SliceLocation"] for x in value]
+	def add(self, studies):
+		"""
+		加入任务, 已存在的检查不重复加入, 返回新加入的数量
+		检查目录保存为绝对路径, 各节点的工作进程不按自己的工作目录解析
+		"""
+		before = self.count()
+		now = time.time()
+		self.conn.execute("BEGIN IMMEDIATE")
+		self.conn.executemany(
+			"INSERT OR IGNORE INTO jobs VALUES (?, 'pending', NULL, 0, 0, NULL, ?)",
+			[(os.path.abspath(x), now) for x in studies],
+		)
+		self.conn.execute("COMMIT")
+		return self.count() - before
 
-				location_counter = Counter(location_value)
+	def lease(self, worker, lease_seconds):
+		"""租用一个等待中或租约已过期的任务, 没有任务时返回 None"""
+		now = time.time()
+		self.conn.execute("BEGIN IMMEDIATE")
+		try:
+			# 租约多次过期 (工作进程反复崩溃) 的任务视为失败
+			self.conn.execute(
+				"UPDATE jobs SET status = 'failed', updated = ? "
+				"WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+				(now, now, self.max_attempts),
+			)
+			row = self.conn.execute(
+				"SELECT study FROM jobs WHERE "
+				"status = 'pending' OR (status = 'leased' AND lease_until < ?) "
+				"ORDER BY attempts, study LIMIT 1",
+				(now,),
+			).fetchone()
+			if row is not None:
+				self.conn.execute(
+					"UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, "
+					"attempts = attempts + 1, updated = ? WHERE study = ?",
+					(worker, now + lease_seconds, now, row[0]),
+				)
+		except BaseException:
+			self.conn.execute("ROLLBACK")
+			raise
+		self.conn.execute("COMMIT")
+		return None if row is None else row[0]
 
-				if not len(location_counter) == len(value):
-					location_value = [
-						item
-						for item in location_value
-						if location_counter[item] > 1
-					]
-					value = [
-						x for x in value if x["SliceLocation"] in location_value
-					]
-					location_drop = [
-						item
-						for item in location_counter
-						if location_counter[item] == 1
-					]
-					logger.info(
-						f"Group {key} has {len(value)} slices, but only {len(location_value)} unique locations. Will Drop {len(location_drop)} locations."
-					)
+	def renew(self, study, worker, lease_seconds):
+		"""续租, 租约已被其他工作进程接管时返回 False"""
+		cursor = self.conn.execute(
+			"UPDATE jobs SET lease_until = ?, updated = ? "
+			"WHERE study = ? AND worker = ? AND status = 'leased'",
+			(time.time() + lease_seconds, time.time(), study, worker),
+		)
+		return cursor.rowcount == 1
 
-				location_uniques = sorted(set(location_value))
+	def finish(self, study, worker, record):
+		"""报告结果, 失败且未超过重试次数时放回队列"""
+		if record["status"] == "done":
+			status = "done"
+		else:
+			attempts = self.conn.execute(
+				"SELECT attempts FROM jobs WHERE study = ?", (study,)
+			).fetchone()[0]
+			status = "failed" if attempts >= self.max_attempts else "pending"
+		cursor = self.conn.execute(
+			"UPDATE jobs SET status = ?, lease_until = 0, record = ?, updated = ? "
+			"WHERE study = ? AND worker = ? AND status = 'leased'",
+			(status, json.dumps(record, ensure_ascii=False), time.time(), study, worker),
+		)
+		if cursor.rowcount != 1:
+			logger.warning(f"Queue: lease of {study} was taken over, result of {worker} ignored.")
 
-				# assert (
-				#     len(value) % len(location_uniques) == 0
-				# ), f"Group {key} has {len(value)} slices, but only {len(location_uniques)} unique locations."
+	def retry_failed(self):
+		cursor = self.conn.execute(
+			"UPDATE jobs SET status = 'pending', attempts = 0, updated = ? "
+			"WHERE status = 'failed'",
+			(time.time(),),
+		)
+		return cursor.rowcount
 
-				value_by_location = {}
-				for location in location_uniques:
-					value_by_location[location] = []
-				for v in value:
-					value_by_location[v["SliceLocation"]].append(v)
+	def count(self, status=None):
+		if status is None:
+			return self.conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+		return self.conn.execute(
+			"SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)
+		).fetchone()[0]
 
-				split_num = len(value) // len(location_uniques)
+	def stats(self):
+		"""各状态的任务数和已完成任务的汇总"""
+		stats = dict(
+			self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+		)
+		series = Counter()
+		files = size = 0
+		stages = []
+		for (record,) in self.conn.execute(
+			"SELECT record FROM jobs WHERE status = 'done'"
+		):
+			record = json.loads(record)
+			series.update(record["series"])
+			files += record["files"]
+			size += record["bytes"]
+			stages.append(record.get("stages", {}))
+		stats.update(
+			files=files,
+			series=dict(series),
+			bytes=size,
+			stages=merge_stage_reports(stages),
+		)
+		return stats
 
-				logger.info(f"Use SliceLocation Will Split {split_num} Series.")
+	def close(self):
+		self.conn.close()
 
-				# if len(location_uniques) == 22:
-				#     pass
 
-				for i in range(split_num):
-					sub_files = []
-					for location in location_uniques:
-						sub_files.append(
-							value_by_location[location][i]["file_path"]
-						)
+def run_queue_worker(
+	queue_file,
+	save_path,
+	worker=None,
+	lease_seconds=600,
+	wait_seconds=0,
+	max_attempts=3,
+	split_kwargs=None,
+):
+	"""
+	工作进程: 循环租用并处理任务, 处理时后台线程每 lease_seconds / 3 秒续租一次
+	队列为空时等待 wait_seconds 秒后退出 (其他进程可能还会放回失败的任务)
+	返回处理的检查数
+	"""
+	worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+	split_kwargs = split_kwargs or {}
+	queue = WorkQueue(queue_file, max_attempts=max_attempts)
+	processed = 0
+	idle_since = None
+	try:
+		while True:
+			study = queue.lease(worker, lease_seconds)
+			if study is None:
+				idle_since = idle_since or time.time()
+				if time.time() - idle_since >= wait_seconds:
+					break
+				time.sleep(min(5, max(wait_seconds, 0.1)))
+				continue
+			idle_since = None
+			logger.info(f"Queue: {worker} lease {study}.")
 
-					patient_id = (
-						value[0]["PatientID"]
-						if value[0]["PatientID"] != ""
-						else "NonePatientID"
-					)
-					accession_number = (
-						value[0]["AccessionNumber"]
-						if value[0]["AccessionNumber"] != ""
-						else "NoneAccessionNumber"
-					)
-					study_id = (
-						value[0]["StudyID"]
-						if value[0]["StudyID"] != ""
-						else "NoneStudyID"
-					)
+			stop = threading.Event()
 
-					patient_id = sanitize_file_name(patient_id)
-					accession_number = sanitize_file_name(accession_number)
-					study_id = sanitize_file_name(study_id)
+			def heartbeat():
+				# sqlite3 连接不能跨线程使用, 续租使用单独的连接
+				renew_queue = WorkQueue(queue_file, max_attempts=max_attempts)
+				try:
+					while not stop.wait(lease_seconds / 3):
+						if not renew_queue.renew(study, worker, lease_seconds):
+							logger.warning(f"Queue: lost lease of {study}.")
+							break
+				finally:
+					renew_queue.close()
 
-					if (
-						patient_id == "NonePatientID"
-						and accession_number == "NoneAccessionNumber"
-					):
-						logger.warning(
-							f"PatientID and AccessionNumber are [NA] in {sub_files[0]} !!!, will skip."
-						)
-						will_save_folder = (
-							f"NonePatientID/NoneAccessionNumber/{study_id}"
-						)
-					else:
-						will_save_folder = "/".join(
-							[patient_id, accession_number]
-						)
+			thread = Thread(target=heartbeat, daemon=True)
+			thread.start()
+			try:
+				record = convert_study(study, save_path, **split_kwargs)
+			except Exception as e:
+				logger.error(f"Queue: error in {study}. Error: {e}")
+				record = {
+					"study": study,
+					"status": "failed",
+					"files": 0,
+					"series": {},
+					"bytes": 0,
+					"error": f"{type(e).__name__}: {e}",
+				}
+			finally:
+				stop.set()
+				thread.join()
+			record["worker"] = worker
+			queue.finish(study, worker, record)
+			processed += 1
+			logger.info(f"Queue: {worker} {record['status']} {study}.")
+	finally:
+		queue.close()
+	return processed
 
-					index = (
-						0
-						if will_save_folder != will_save_folder_flag
-						else index
-					)
-					will_save_folder_flag = will_save_folder
-					series_data = SeriesData(
-						index=index,
-						files=sub_files,
-						will_save_file=f"{file_name}-{i}",
-						will_save_folder=will_save_folder,
-						will_save_root_path=self.will_save_root_path,
-					)
 
-					logger.info(f"Create {series_data} successfully.")
+class SplitJob:
+	"""
+	在后台线程中运行拆分和保存, 提供进度, ETA, 暂停/继续和取消
+	暂停和取消在读取每个文件和提交每个序列前生效, 已提交的序列会保存完
+	取消后重新运行时已保存的输出会被跳过 (启用 manifest 时按清单跳过), 已完成的工作不会丢失
+	"""
 
-					split_list.append(series_data)
-					index += 1
+	def __init__(self, split, root_path, max_memory=None, retries=1):
+		self.split = split
+		self.root_path = root_path
+		self.max_memory = max_memory
+		self.retries = retries
+		self.state = "pending"
+		self.results = None
+		self.error = None
+		self.finished = threading.Event()
+		self._resume = threading.Event()
+		self._resume.set()
+		self._cancelled = False
+		self._pauses = []  # [(开始, 结束或 None)], 计算 ETA 时扣除暂停的时间
+		self._thread = None
+		split.checkpoint = self.checkpoint
 
-		self.split_list = split_list
-		return split_list
+	def start(self):
+		self.state = "running"
+		self._thread = Thread(target=self._run, daemon=True)
+		self._thread.start()
+		return self
 
+	def _run(self):
+		try:
+			split_list = self.split(self.root_path)
+			if split_list is None:
+				raise RuntimeError(f"Error in splitting {self.root_path}, see log for details.")
+			self.results = self.split.export(
+				split_list, max_memory=self.max_memory, retries=self.retries
+			)
+			self.state = "done"
+		except JobCancelled:
+			self.state = "cancelled"
+			logger.warning(f"Job cancelled: {self.split.progress.snapshot()}")
+		except Exception as e:
+			self.state = "failed"
+			self.error = e
+			logger.exception(e)
+		finally:
+			self.finished.set()
 
-@dataclass
-class SeriesData:
-	index: int
-	files: list
-	will_save_file: str
-	will_save_folder: str
-	will_save_root_path: str
+	def checkpoint(self):
+		if not self._resume.is_set():
+			self._resume.wait()
+		if self._cancelled:
+			raise JobCancelled()
 
-	def __repr__(self):
-		return f"SeriesData(index={self.index}, will_save_file={self.will_save_file}, files_length={len(self.files)})"
+	def pause(self):
+		if self.state == "running":
+			self.state = "paused"
+			self._pauses.append([time.monotonic(), None])
+			self._resume.clear()
+			logger.info("Job paused.")
 
-	@logger.catch
-	def to_itk(self):
-		reader = sitk.ImageSeriesReader()
-		reader.SetFileNames(self.files)
-		image = reader.Execute()
+	def resume(self):
+		if self.state == "paused":
+			self.state = "running"
+			self._pauses[-1][1] = time.monotonic()
+			self._resume.set()
+			logger.info("Job resumed.")
 
-		return image
+	def cancel(self):
+		if self.state in ("running", "paused"):
+			if self.state == "paused":
+				self._pauses[-1][1] = time.monotonic()
+			self.state = "cancelling"
+			self._cancelled = True
+			self._resume.set()
 
-	@logger.catch
-	def to_save_nifti(self):
-		save_path = os.path.join(
-			self.will_save_root_path, self.will_save_folder
-		)
-		if not os.path.exists(save_path):
-			os.makedirs(save_path)
+	def wait(self, timeout=None):
+		return self.finished.wait(timeout)
 
-		save_file = os.path.join(
-			save_path,
-			f"{self.index:02d}-L{len(self.files):03d}-{self.will_save_file}.nii.gz",
+	def paused_seconds(self, since):
+		now = time.monotonic()
+		return sum(
+			max(0.0, (end or now) - max(start, since))
+			for start, end in self._pauses
+			if (end or now) > since
 		)
-		if os.path.exists(save_file):
-			logger.info(f"File {save_file} already exists. Skip.")
-			return
 
-		image = self.to_itk()
-
-		sitk.WriteImage(image, save_file, True)
-		logger.info(f"Save file {save_file} successfully.")
+	def progress(self):
+		"""返回当前阶段的进度 (done/total), 比例, 预计剩余时间 (秒, 未知时为 None) 和各计数"""
+		progress = self.split.progress
+		counts = progress.snapshot()
+		phase = progress.phase
+		if phase == "scanning":
+			done, total = counts.get("files_prechecked", 0), counts.get("files_scanned", 0)
+		elif phase == "reading":
+			done = counts.get("files_read", 0) + counts.get("files_cached", 0)
+			total = counts.get("files_total") or counts.get("files_scanned", 0)
+		elif phase == "exporting":
+			done, total = counts.get("series_exported", 0), counts.get("series_found", 0)
+		else:
+			done, total = 0, 0
+		elapsed = time.monotonic() - progress.phase_start
+		elapsed -= self.paused_seconds(progress.phase_start)
+		eta = None
+		if done and total > done and elapsed > 0:
+			eta = (total - done) * elapsed / done
+		return {
+			"state": self.state,
+			"phase": phase,
+			"done": done,
+			"total": total,
+			"fraction": min(done / total, 1.0) if total else 0.0,
+			"eta_s": None if eta is None else round(eta, 1),
+			"elapsed_s": round(time.monotonic() - progress.start_time, 1),
+			**counts,
+		}
 
 
 class DicomApp:
+	LOG_MAX_LINES = 2000
+
 	def __init__(self, root):
 		self.root = root
 		self.root.title(f"DICOM Splitter v{_version}")
-		self.root.geometry("800x630")
+		self.root.geometry("800x690")
+		self.job = None
 
 		self.label = tk.Label(root, text="Select DICOM Root Path:")
 		self.label.grid(row=0, column=0, padx=10, pady=10, sticky=tk.W)
@@ -647,6 +3724,12 @@ class DicomApp:
 		self.timeout_entry.grid(row=3, column=1, padx=10, pady=10, sticky=tk.W)
 		self.timeout_entry.insert(0, "2")
 
+		self.cache_var = tk.BooleanVar(value=True)
+		self.cache_check = tk.Checkbutton(
+			root, text="Use Cache(元数据缓存)", variable=self.cache_var
+		)
+		self.cache_check.grid(row=3, column=2, padx=10, pady=10)
+
 		save_file_format_example = (
 			"Save File Format: SAVEPATH/PatientID/AccessionNumber/"
 			"[Index]-L[length]-[SeriesDescription]-[ProtocolName]-[AcquisitionTime]-[I].nii.gz\n"
@@ -668,7 +3751,8 @@ class DicomApp:
 			"  2. Select a save path.\n"
 			"  3. Set the minimum number of slices for a series.\n"
 			"  4. Set the timeout for reading DICOM files.\n"
-			"  5. Click 'Run' to start the splitting process."
+			"  5. Click 'Run' to start the splitting process. "
+			"'Pause'/'Cancel' keep saved files, run again to continue."
 		)
 		self.user_manual_label = tk.Label(
 			root, text=user_manual, justify=tk.LEFT, wraplength=700
@@ -700,6 +3784,25 @@ class DicomApp:
 			sticky=tk.W + tk.E + tk.N + tk.S,
 		)
 
+		self.progress_bar = ttk.Progressbar(root, mode="determinate", maximum=100)
+		self.progress_bar.grid(
+			row=8, column=0, columnspan=2, padx=1, pady=5, sticky=tk.W + tk.E
+		)
+		self.status_label = tk.Label(root, text="", justify=tk.LEFT, anchor=tk.W)
+		self.status_label.grid(
+			row=9, column=0, columnspan=3, padx=10, pady=2, sticky=tk.W
+		)
+		self.job_frame = tk.Frame(root)
+		self.job_frame.grid(row=8, column=2, padx=10, pady=5)
+		self.pause_button = tk.Button(
+			self.job_frame, text="Pause", command=self.toggle_pause, state=tk.DISABLED
+		)
+		self.pause_button.pack(side=tk.LEFT, padx=2)
+		self.cancel_button = tk.Button(
+			self.job_frame, text="Cancel", command=self.cancel, state=tk.DISABLED
+		)
+		self.cancel_button.pack(side=tk.LEFT, padx=2)
+
 		# 配置 grid 行/列权重以使 log_area 可扩展
 		root.grid_rowconfigure(6, weight=1)
 		root.grid_columnconfigure(1, weight=1)
@@ -717,11 +3820,22 @@ class DicomApp:
 			self.save_entry.insert(0, directory)
 
 	def write_log(self, message):
+		"""只在 Tk 主线程中调用, 文本框最多保留 LOG_MAX_LINES 行"""
 		self.log_area.configure(state="normal")
 		self.log_area.insert(tk.END, message + "\n")
+		lines = int(self.log_area.index("end-1c").split(".")[0])
+		if lines > self.LOG_MAX_LINES:
+			self.log_area.delete("1.0", f"{lines - self.LOG_MAX_LINES}.0")
 		self.log_area.configure(state="disabled")
 		self.log_area.yview(tk.END)
 
+	def poll_log(self, log_handler):
+		"""每 100ms 把工作线程产生的日志批量写入文本框"""
+		messages = log_handler.drain()
+		if messages:
+			self.write_log("\n".join(messages))
+		self.root.after(100, self.poll_log, log_handler)
+
 	@logger.catch
 	def run(self):
 		root_path = self.path_entry.get()
@@ -743,86 +3857,459 @@ class DicomApp:
 		if float(timeout) <= 0:
 			messagebox.showerror("Error", "Timeout must be a positive number")
 			return
+		if not os.path.isdir(save_path):
+			messagebox.showerror("Error", "Save path does not exist")
+			return
+
+		try:
+			split = make_splitter(
+				save_path.replace(os.sep, "/"),
+				timeout=float(timeout),
+				min_slices=int(min_slices),
+				cache=self.cache_var.get(),
+			)
+		except Exception as e:
+			logger.exception(f"Failed to create splitter: {e}")
+			messagebox.showerror("Error", f"Failed to create splitter: {e}")
+			return
 
 		self.run_button.config(state=tk.DISABLED)
+		self.job = SplitJob(
+			split, root_path.replace(os.sep, "/"), max_memory=4 * 1024**3
+		).start()
+		self.pause_button.config(state=tk.NORMAL, text="Pause")
+		self.cancel_button.config(state=tk.NORMAL)
+		self.poll_job()
+
+	def toggle_pause(self):
+		if self.job is None:
+			return
+		if self.job.state == "paused":
+			self.job.resume()
+			self.pause_button.config(text="Pause")
+		else:
+			self.job.pause()
+			self.pause_button.config(text="Resume")
 
-		thread = Thread(
-			target=self.run_splitter,
-			args=(root_path, save_path, int(min_slices), float(timeout)),
+	def cancel(self):
+		if self.job is not None:
+			self.job.cancel()
+			self.pause_button.config(state=tk.DISABLED)
+			self.cancel_button.config(state=tk.DISABLED)
+
+	def poll_job(self):
+		"""每 500ms 在 Tk 主线程中刷新进度条和状态"""
+		job = self.job
+		progress = job.progress()
+		self.progress_bar["value"] = progress["fraction"] * 100
+		eta = progress["eta_s"]
+		self.status_label.config(
+			text=(
+				f"[{progress['state']}] {progress['phase'] or ''} "
+				f"{progress['done']}/{progress['total']}"
+				f"{'' if eta is None else f', ETA {eta:.0f}s'}  |  "
+				f"files {progress.get('files_scanned', 0)}, "
+				f"series {progress.get('series_exported', 0)}/{progress.get('series_found', 0)}, "
+				f"{progress.get('bytes_written', 0) / 1024**2:.1f} MB, "
+				f"elapsed {progress['elapsed_s']:.0f}s"
+			)
 		)
-		thread.start()
+		if job.finished.is_set():
+			self.job_finished(job)
+		else:
+			self.root.after(500, self.poll_job)
 
 	@logger.catch
-	def run_splitter(self, root_path, save_path, min_slices, timeout):
-		root_path = root_path.replace(os.sep, "/")
-		save_path = save_path.replace(os.sep, "/")
-
-		meta_keys = [
-			"PatientID",
-			"StudyID",
-			"AccessionNumber",
-			"ProtocolName",
-			"SeriesInstanceUID",
-			"SliceLocation",
-			"InstanceNumber",
-			"SeriesNumber",
-			"SeriesDescription",
-			"AcquisitionTime",
-		]
+	def job_finished(self, job):
+		self.run_button.config(state=tk.NORMAL)
+		self.pause_button.config(state=tk.DISABLED, text="Pause")
+		self.cancel_button.config(state=tk.DISABLED)
+		if job.state == "cancelled":
+			messagebox.showinfo(
+				"Cancelled", "Cancelled. Saved series are kept, run again to continue."
+			)
+			return
+		if job.state == "failed":
+			messagebox.showerror("Error", f"An error occurred: {job.error}")
+			return
 
-		split = DicomSeriesSplit(
-			timeout=timeout,
-			n_jobs=8,
-			min_slices=min_slices,
-			meta_keys=meta_keys,
-			backend="spawn",
-			# will_save_file_keys=["SeriesDescription"],
-			will_save_file_keys=[
-				"SeriesDescription",
-				"ProtocolName",
-				"AcquisitionTime",
-			],
-			will_save_folder_keys=["PatientID", "AccessionNumber"],
-			will_save_root_path=save_path,
+		report_file = os.path.join(
+			"log", time.strftime("run_report_%Y%m%d-%H%M%S.json")
 		)
-
-		try:
-			split_files = split(root_path)
-			for split_file in split_files:
-				split_file.to_save_nifti()
+		job.split.profiler.write(report_file)
+		summary = job.split.profiler.summary()
+		logger.info(f"Stage report saved to {report_file}:\n{summary}")
+		failed = [x for x in job.results if x["status"] == "failed"]
+		if failed:
+			messagebox.showwarning(
+				"Warning",
+				f"{len(failed)}/{len(job.results)} series failed to save, see log for details.",
+			)
+		else:
 			messagebox.showinfo(
-				"Success", "DICOM splitting and saving completed."
+				"Success", f"DICOM splitting and saving completed.\n\n{summary}"
 			)
-		except Exception as e:
-			messagebox.showerror("Error", f"An error occurred: {e}")
-		finally:
-			self.run_button.config(state=tk.NORMAL)
 
 
-if __name__ == "__main__":
-	# freeze_support()
+class LogHandler:
+	"""
+	GUI 日志 sink: 工作线程只把日志放入队列, 由 Tk 主循环通过 after() 取出 (DicomApp.poll_log)
+	队列满时丢弃并计数, 完整日志在日志文件中
+	"""
 
-	root = tk.Tk()
-	app = DicomApp(root)
+	def __init__(self, app, maxsize=10000):
+		self.app = app
+		self.queue = queue.Queue(maxsize=maxsize)
+		self.dropped = 0
 
-	class LogHandler:
-		def __init__(self, app):
-			self.app = app
+	def write(self, message):
+		if message.strip():  # ignore empty messages
+			try:
+				self.queue.put_nowait(message.strip())
+			except queue.Full:
+				self.dropped += 1
 
-		def write(self, message):
-			if message.strip():  # ignore empty messages
-				self.app.write_log(message.strip())
+	def flush(self):
+		pass
 
-		def flush(self):
-			pass
+	def drain(self, max_messages=500):
+		messages = []
+		while len(messages) < max_messages:
+			try:
+				messages.append(self.queue.get_nowait())
+			except queue.Empty:
+				break
+		if self.dropped:
+			messages.append(f"... {self.dropped} messages dropped, see log file.")
+			self.dropped = 0
+		return messages
+
+
+def run_gui():
+	root = tk.Tk()
+	app = DicomApp(root)
 
 	log_save_path = "log"
 	os.makedirs(log_save_path, exist_ok=True)
 	logger.remove()
-	logger.add(log_save_path + "/dicom_splitter_app.log", rotation="100 MB")
-	logger.add(LogHandler(app))
+	# 逐个文件的 debug 日志只写入文件, 界面只显示 info 及以上
+	logger.add(
+		log_save_path + "/dicom_splitter_app.log", rotation="100 MB", level="DEBUG"
+	)
+	log_handler = LogHandler(app)
+	logger.add(log_handler, level="INFO")
+	app.poll_log(log_handler)
 	root.mainloop()
 
+
+def run_cache_command(args):
+	split = DicomSeriesSplit(
+		meta_keys=APP_META_KEYS,
+		will_save_root_path=args.save_path,
+		timeout=args.timeout,
+		n_jobs=args.n_jobs,
+	)
+	if args.action == "rebuild" and args.dicom_path:
+		count = split.rebuild_cache(args.dicom_path)
+		print(f"Rebuild {split.cache_file}: {count} entries.")
+		return
+
+	cache = split.open_cache()
+	try:
+		if args.action == "stats":
+			print(f"{cache.cache_file}: {cache.count()} entries.")
+		elif args.action == "prune":
+			print(f"Prune {cache.prune()} stale entries, {cache.count()} left.")
+		elif args.action == "rebuild":
+			cache.clear()
+			print(f"Clear {cache.cache_file}.")
+	finally:
+		cache.close()
+
+
+def run_rules_command(args):
+	if args.action == "dump":
+		text = json.dumps(DEFAULT_FILTER_RULES, indent=2, ensure_ascii=False)
+		if args.file:
+			with open(args.file, "w", encoding="utf-8") as f:
+				f.write(text + "\n")
+			print(f"Write default filter rules to {args.file}.")
+		else:
+			print(text)
+	elif args.action == "check":
+		series_filter = SeriesFilter(args.file or FILTER_RULES_FILE)
+		print(
+			f"{len(series_filter.vendors)} vendors: "
+			f"{[vendor for vendor, _ in series_filter.vendors]}"
+		)
+
+
+def add_split_arguments(parser, n_jobs=8, backend="spawn", cache=True):
+	"""cache: 默认是否使用元数据缓存; 多个进程 / 节点共用保存路径时应为 False, 由 --cache 显式启用"""
+	parser.add_argument("--min-slices", type=int, default=10)
+	parser.add_argument("--timeout", type=float, default=60)
+	parser.add_argument(
+		"--n-jobs", type=int, default=n_jobs, help="读取元数据和保存的并行数"
+	)
+	parser.add_argument("--backend", default=backend)
+	parser.add_argument("--output-format", default="nii.gz", choices=OUTPUT_FORMATS)
+	parser.add_argument("--compression-level", type=int, default=-1)
+	parser.add_argument(
+		"--stream-threshold",
+		type=float,
+		default=None,
+		help="估计大小不小于该值 (MB) 的序列逐块写入, 默认 1024",
+	)
+	parser.add_argument("--filter-rules", default=None, help="过滤规则 JSON 文件")
+	parser.add_argument(
+		"--split-mode",
+		default="location",
+		choices=SPLIT_MODES,
+		help="location: 按 SliceLocation 拆分; geometry: 按 ImagePositionPatient 投影拆分",
+	)
+	parser.add_argument(
+		"--prefetch",
+		type=int,
+		default=0,
+		help="并发预读文件开头的最大在途读取数 (按延迟自适应), 适合网络存储, 0 为不预读",
+	)
+	if cache:
+		parser.add_argument(
+			"--no-cache", dest="cache", action="store_false", help="不使用元数据缓存"
+		)
+	else:
+		parser.add_argument(
+			"--cache",
+			action="store_true",
+			help="使用元数据缓存 (所有工作进程共用保存路径下的 SQLite 文件, 网络文件系统上的锁可能不可靠)",
+		)
+	parser.add_argument(
+		"--cprofile", default=None, help="每个检查的 cProfile 结果保存到该目录"
+	)
+
+
+def split_kwargs_from_args(args):
+	kwargs = dict(
+		min_slices=args.min_slices,
+		timeout=args.timeout,
+		n_jobs=args.n_jobs,
+		backend=None if args.backend == "threading" else args.backend,
+		output_format=args.output_format,
+		compression_level=args.compression_level,
+		cache=args.cache,
+		split_mode=args.split_mode,
+		prefetch=args.prefetch,
+	)
+	if args.filter_rules:
+		kwargs["filter_rules"] = args.filter_rules
+	if args.stream_threshold is not None:
+		kwargs["stream_threshold"] = int(args.stream_threshold * 1024**2)
+	if args.cprofile:
+		os.makedirs(args.cprofile, exist_ok=True)
+		kwargs["profile_dir"] = os.path.abspath(args.cprofile)
+	return kwargs
+
+
+def run_watch_command(args):
+	watch = WatchFolder(
+		args.input_path,
+		args.save_path,
+		quiet=args.quiet,
+		interval=args.interval,
+		study_depth=args.study_depth,
+		metrics_file=args.metrics,
+		polling=args.polling,
+		**split_kwargs_from_args(args),
+	)
+	signal.signal(signal.SIGTERM, lambda *_: watch.stop())
+	try:
+		watch.run()
+	except KeyboardInterrupt:
+		watch.stop()
+
+
+def read_studies_file(studies_file):
+	"""每行一个检查目录, 忽略空行和 # 开头的行"""
+	with open(studies_file, "r", encoding="utf-8") as f:
+		lines = [x.strip() for x in f]
+	return [x for x in lines if x and not x.startswith("#")]
+
+
+def run_batch_command(args):
+	studies = []
+	for root_path in args.roots:
+		studies.extend(iter_study_dirs(root_path, args.study_depth))
+	if args.studies_file:
+		studies.extend(read_studies_file(args.studies_file))
+	if not studies:
+		raise SystemExit("No study folders found.")
+
+	runner = BatchRunner(
+		args.save_path,
+		studies,
+		workers=args.workers,
+		shards=args.shards,
+		work_dir=args.work_dir,
+		**split_kwargs_from_args(args),
+	)
+	summary = runner.run()
+	text = json.dumps(summary, indent=2, ensure_ascii=False)
+	if args.summary:
+		with open(args.summary, "w", encoding="utf-8") as f:
+			f.write(text + "\n")
+	print(text)
+	if summary["failed"]:
+		raise SystemExit(1)
+
+
+def run_queue_command(args):
+	if args.action == "work":
+		kwargs = dict(
+			lease_seconds=args.lease,
+			wait_seconds=args.wait,
+			max_attempts=args.max_attempts,
+			split_kwargs=split_kwargs_from_args(args),
+		)
+		if args.processes == 1:
+			count = run_queue_worker(args.queue_file, args.save_path, args.worker_id, **kwargs)
+		else:  # 本机启动多个工作进程
+			with get_executor(args.processes, "spawn") as executor:
+				futures = [
+					executor.submit(run_queue_worker, args.queue_file, args.save_path, None, **kwargs)
+					for _ in range(args.processes)
+				]
+				count = sum(x.result() for x in futures)
+		print(f"Processed {count} studies.")
+		return
+
+	queue = WorkQueue(args.queue_file)
+	try:
+		if args.action == "add":
+			studies = []
+			for root_path in args.roots:
+				studies.extend(iter_study_dirs(root_path, args.study_depth))
+			if args.studies_file:
+				studies.extend(read_studies_file(args.studies_file))
+			print(f"Add {queue.add(studies)} studies, {queue.count()} in total.")
+		elif args.action == "retry":
+			print(f"Retry {queue.retry_failed()} failed studies.")
+		print(json.dumps(queue.stats(), indent=2, ensure_ascii=False))
+	finally:
+		queue.close()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(
+		description=f"DICOM Splitter v{_version}, 不带参数时启动 GUI"
+	)
+	subparsers = parser.add_subparsers(dest="command")
+
+	cache_parser = subparsers.add_parser("cache", help="管理元数据缓存")
+	cache_parser.add_argument("action", choices=["stats", "prune", "rebuild"])
+	cache_parser.add_argument("save_path", help="NIfTI 保存路径 (缓存所在位置)")
+	cache_parser.add_argument(
+		"--dicom-path", help="rebuild 时重新读取该路径下的 DICOM 元数据"
+	)
+	cache_parser.add_argument("--timeout", type=float, default=60)
+	cache_parser.add_argument("--n-jobs", type=int, default=8)
+
+	rules_parser = subparsers.add_parser("rules", help="导出或检查序列过滤规则")
+	rules_parser.add_argument("action", choices=["dump", "check"])
+	rules_parser.add_argument(
+		"file", nargs="?", help=f"规则文件, 默认 {FILTER_RULES_FILE}"
+	)
+
+	watch_parser = subparsers.add_parser(
+		"watch", help="监视接收目录, 检查静止后自动拆分保存 (Ctrl+C 停止)"
+	)
+	watch_parser.add_argument("input_path", help="DICOM 接收目录")
+	watch_parser.add_argument("save_path", help="NIfTI 保存路径")
+	watch_parser.add_argument(
+		"--quiet", type=float, default=10, help="检查目录静止多少秒后处理"
+	)
+	watch_parser.add_argument("--interval", type=float, default=2, help="轮询间隔 (秒)")
+	watch_parser.add_argument(
+		"--study-depth", type=int, default=1, help="检查目录在接收目录下的层数"
+	)
+	watch_parser.add_argument("--metrics", default=None, help="指标 JSON 文件")
+	watch_parser.add_argument(
+		"--polling", action="store_true", help="不使用 watchdog, 强制轮询"
+	)
+	add_split_arguments(watch_parser)
+
+	batch_parser = subparsers.add_parser(
+		"batch", help="批量处理多个检查目录, 按检查分片到多个进程"
+	)
+	batch_parser.add_argument("save_path", help="NIfTI 保存路径")
+	batch_parser.add_argument("roots", nargs="*", help="DICOM 根目录")
+	batch_parser.add_argument(
+		"--studies-file", default=None, help="检查目录列表文件, 每行一个"
+	)
+	batch_parser.add_argument(
+		"--study-depth",
+		type=int,
+		default=1,
+		help="检查目录在根目录下的层数, 0 表示根目录本身就是一个检查",
+	)
+	batch_parser.add_argument(
+		"--workers", type=int, default=-1, help="进程数 (-1 为全部 CPU)"
+	)
+	batch_parser.add_argument(
+		"--shards", type=int, default=None, help="分片数, 默认为进程数的 4 倍"
+	)
+	batch_parser.add_argument(
+		"--work-dir",
+		default=None,
+		help=f"日志和状态目录, 默认为保存路径下的 {BatchRunner.work_dir_name}",
+	)
+	batch_parser.add_argument("--summary", default=None, help="汇总 JSON 文件")
+	# 每个进程内用线程读取, 避免进程池嵌套
+	add_split_arguments(batch_parser, n_jobs=4, backend="threading", cache=False)
+
+	queue_parser = subparsers.add_parser(
+		"queue", help="分布式处理: 共享目录上的任务队列, 多个节点的工作进程租用检查"
+	)
+	queue_subparsers = queue_parser.add_subparsers(dest="action", required=True)
+	queue_add_parser = queue_subparsers.add_parser("add", help="把检查目录加入队列")
+	queue_add_parser.add_argument("queue_file", help="队列文件 (SQLite)")
+	queue_add_parser.add_argument("roots", nargs="*", help="DICOM 根目录")
+	queue_add_parser.add_argument("--studies-file", default=None)
+	queue_add_parser.add_argument("--study-depth", type=int, default=1)
+	queue_work_parser = queue_subparsers.add_parser("work", help="工作进程")
+	queue_work_parser.add_argument("queue_file")
+	queue_work_parser.add_argument("save_path", help="NIfTI 保存路径")
+	queue_work_parser.add_argument("--worker-id", default=None, help="默认为 主机名-进程号")
+	queue_work_parser.add_argument(
+		"--processes", type=int, default=1, help="本机启动的工作进程数"
+	)
+	queue_work_parser.add_argument("--lease", type=float, default=600, help="租约时长 (秒)")
+	queue_work_parser.add_argument(
+		"--wait", type=float, default=0, help="队列为空时等待多少秒后退出"
+	)
+	queue_work_parser.add_argument("--max-attempts", type=int, default=3)
+	add_split_arguments(queue_work_parser, n_jobs=4, backend="threading", cache=False)
+	for action in ["status", "retry"]:
+		queue_subparsers.add_parser(action).add_argument("queue_file")
+
+	args = parser.parse_args(argv)
+	if args.command == "cache":
+		run_cache_command(args)
+	elif args.command == "queue":
+		run_queue_command(args)
+	elif args.command == "batch":
+		run_batch_command(args)
+	elif args.command == "watch":
+		run_watch_command(args)
+	elif args.command == "rules":
+		run_rules_command(args)
+	else:
+		run_gui()
+
+
+if __name__ == "__main__":
+	freeze_support()
+	main()
+
 # pyinstaller -F -w --hiddenimport=pydicom.encoders.gdcm --hiddenimport=pydicom.encoders.pylibjpeg app.1.74.py -n DicomSplitter1.74.exe
 
 # 同反相位 同时存在 AcquisitionNumber 和 SliceLocation 可分情况，使用 AcquisitionNumber 拆分会导致拆分错误，增加了 判断条件 此时使用 SliceLocation 拆分
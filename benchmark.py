@@ -0,0 +1,823 @@
+import os
+import sys
+import time
+import json
+import random
+import hashlib
+import platform
+import argparse
+import tempfile
+import threading
+from collections import Counter
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, generate_uid
+from loguru import logger
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+try:
+	import resource
+except ImportError:  # Windows
+	resource = None
+
+from app import (
+	APP_META_KEYS,
+	DicomSeriesSplit,
+	Prefetcher,
+	WorkQueue,
+	iter_study_dirs,
+	read_metadata_list,
+	run_queue_worker,
+	sanitize_file_name,
+	write_image,
+	_version,
+)
+
+# (output_format, compression_level, gzip_jobs)
+COMPRESSION_SETTINGS = [
+	("nii.gz", -1, 1),
+	("nii.gz", 1, 1),
+	("nii.gz", 6, 1),
+	("nii.gz", 9, 1),
+	("nii.gz", 1, 4),
+	("nii.gz", 6, 4),
+	("nii", -1, 1),
+	("nrrd", 0, 1),
+	("nrrd", 1, 1),
+	("mha", 1, 1),
+]
+
+
+def make_volume(shape, seed=0):
+	"""生成类似 CT/MR 的平滑体数据 (int16), 比随机噪声更接近真实的压缩率"""
+	rng = np.random.default_rng(seed)
+	z, y, x = np.meshgrid(
+		*[np.linspace(0, 1, n, dtype=np.float32) for n in shape], indexing="ij"
+	)
+	volume = 800 * np.sin(6 * x) * np.cos(5 * y) + 400 * z
+	volume += rng.normal(0, 20, size=shape).astype(np.float32)
+	image = sitk.GetImageFromArray(volume.astype(np.int16))
+	image.SetSpacing((0.8, 0.8, 2.0))
+	return image
+
+
+def bench_compression(image, settings=None, repeat=3, work_dir=None):
+	"""按每种输出设置保存 image, 返回 MB/s (按未压缩大小计算) 和压缩率"""
+	settings = settings or COMPRESSION_SETTINGS
+	raw_mb = image.GetNumberOfPixels() * image.GetSizeOfPixelComponent() / 1024**2
+	results = []
+	with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+		for output_format, compression_level, gzip_jobs in settings:
+			save_file = os.path.join(temp_dir, f"bench.{output_format}")
+			seconds = []
+			for _ in range(repeat):
+				start = time.perf_counter()
+				write_image(image, save_file, output_format, compression_level, gzip_jobs)
+				seconds.append(time.perf_counter() - start)
+			best = min(seconds)
+			results.append(
+				{
+					"output_format": output_format,
+					"compression_level": compression_level,
+					"gzip_jobs": gzip_jobs,
+					"seconds": round(best, 4),
+					"mb_per_s": round(raw_mb / best, 1),
+					"ratio": round(os.path.getsize(save_file) / 1024**2 / raw_mb, 3),
+				}
+			)
+			os.remove(save_file)
+	return results
+
+
+# 合成数据中每个检查的序列类型, 依次循环
+# plain: 单期相; aq: 3 个期相共用 SeriesInstanceUID, 第 3 期相层面错开半层, 按 AcquisitionNumber 拆分
+# loc: 2 个期相共用 SeriesInstanceUID 和 AcquisitionNumber, 按 SliceLocation 拆分; localizer: 被过滤的定位像
+SERIES_KINDS = ["plain", "aq", "loc", "localizer"]
+EXPECTED_OUTPUTS = {"plain": 1, "aq": 3, "loc": 2, "localizer": 0}
+VENDORS = ["SIEMENS", "GE MEDICAL SYSTEMS", "Philips Medical Systems"]
+LOCALIZERS = {
+	"SIEMENS": "t2 Map",
+	"GE MEDICAL SYSTEMS": "3-pl loc",
+	"Philips Medical Systems": "SURVEY",
+}
+
+
+def write_slice(path, study, series, slice_info, rows, cols, implicit):
+	"""写入一个合成的 MR 切片, 像素随 InstanceNumber 变化以便检查输出是否一致"""
+	file_meta = FileMetaDataset()
+	file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+	file_meta.MediaStorageSOPInstanceUID = generate_uid()
+	file_meta.TransferSyntaxUID = (
+		ImplicitVRLittleEndian if implicit else ExplicitVRLittleEndian
+	)
+	ds = Dataset()
+	ds.file_meta = file_meta
+	ds.preamble = b"\0" * 128
+	ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+	ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+	ds.PatientID = study["PatientID"]
+	ds.AccessionNumber = study["AccessionNumber"]
+	ds.StudyID = study["StudyID"]
+	ds.StudyInstanceUID = study["StudyInstanceUID"]
+	ds.Manufacturer = series["Manufacturer"]
+	ds.SeriesInstanceUID = series["SeriesInstanceUID"]
+	ds.SeriesDescription = series["SeriesDescription"]
+	ds.SeriesNumber = series["SeriesNumber"]
+	ds.ProtocolName = "ABD"
+	ds.InstanceNumber = slice_info["InstanceNumber"]
+	ds.AcquisitionNumber = slice_info["AcquisitionNumber"]
+	ds.AcquisitionTime = slice_info["AcquisitionTime"]
+	ds.SliceLocation = slice_info["SliceLocation"]
+	ds.ImagePositionPatient = [-100.0, -100.0, slice_info["SliceLocation"]]
+	ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+	ds.PixelSpacing = [0.8, 0.8]
+	ds.SliceThickness = 2.0
+	ds.Rows = rows
+	ds.Columns = cols
+	ds.SamplesPerPixel = 1
+	ds.PhotometricInterpretation = "MONOCHROME2"
+	ds.BitsAllocated = 16
+	ds.BitsStored = 12
+	ds.HighBit = 11
+	ds.PixelRepresentation = 0
+	pixels = np.arange(rows * cols, dtype=np.uint16).reshape(rows, cols)
+	ds.PixelData = ((pixels + slice_info["InstanceNumber"]) % 4096).tobytes()
+	ds.is_implicit_VR = implicit
+	ds.is_little_endian = True
+	pydicom.dcmwrite(path, ds, enforce_file_format=True)
+
+
+def series_description(kind, vendor, se):
+	return LOCALIZERS[vendor] if kind == "localizer" else f"Ax {kind} {se}"
+
+
+def expected_names(n_studies, n_series, n_slices, output_format="nii.gz"):
+	"""
+	generate_archive 的数据按 will_save_file_keys=["SeriesDescription", "ProtocolName"] 保存时预期的输出路径
+	每个检查从 0 编号, 检查内按序列的采集时间 (即序列号) 排列, 与其他检查的采集时间是否交错无关
+	"""
+	names = []
+	for s in range(n_studies):
+		folder = f"P{s:05d}/A{s:06d}"
+		index = 0
+		for se in range(n_series):
+			kind = SERIES_KINDS[se % len(SERIES_KINDS)]
+			vendor = VENDORS[(s + se) % len(VENDORS)]
+			tags = {"plain": ["0"], "aq": ["1", "2", "3"], "loc": ["0", "1"]}.get(kind, [])
+			description = sanitize_file_name(series_description(kind, vendor, se))
+			for tag in tags:
+				names.append(
+					f"{folder}/{index:02d}-L{n_slices:03d}-{description}-ABD-{tag}.{output_format}"
+				)
+				index += 1
+	return sorted(names)
+
+
+def generate_archive(
+	root_path,
+	n_studies=2,
+	n_series=4,
+	n_slices=32,
+	rows=64,
+	cols=64,
+	junk=True,
+	seed=0,
+	interleave=True,
+	filtered_study=False,
+):
+	"""
+	生成 n_studies 个检查 x n_series 个序列 x 每期相 n_slices 个切片的合成 DICOM 数据
+	序列类型按 SERIES_KINDS 循环, junk 为 True 时每个检查加入报告, 图片和空文件等非 DICOM 文件
+	interleave 为 True 时各检查的采集时间错开, 按时间排序后不同病人的序列交替出现
+	filtered_study 为 True 时另加一个只有定位像的检查 (全部被过滤), 目录名保存在 stats["filtered_study"]
+	返回数据的统计和预期的输出序列数
+	"""
+	rng = random.Random(seed)
+	stats = {"files": 0, "dicom": 0, "junk": 0, "expected_outputs": 0}
+	for s in range(n_studies + filtered_study):
+		study = {
+			"PatientID": f"P{s:05d}",
+			"AccessionNumber": f"A{s:06d}",
+			"StudyID": str(s),
+			"StudyInstanceUID": generate_uid(),
+		}
+		study_path = os.path.join(root_path, study["PatientID"])
+		for se in range(n_series):
+			kind = (
+				"localizer" if s == n_studies else SERIES_KINDS[se % len(SERIES_KINDS)]
+			)
+			vendor = VENDORS[(s + se) % len(VENDORS)]
+			series = {
+				"Manufacturer": vendor,
+				"SeriesInstanceUID": generate_uid(),
+				"SeriesDescription": series_description(kind, vendor, se),
+				"SeriesNumber": se + 1,
+			}
+			series_path = os.path.join(study_path, f"S{se:03d}")
+			os.makedirs(series_path, exist_ok=True)
+			phases = {"aq": 3, "loc": 2}.get(kind, 1)
+			instance = 1
+			# 错开时每个检查晚 10 秒, 仍早于本检查的下一个序列 (相差 100)
+			start_time = 100000 + se * 100 + (s % 9) * 10 * interleave
+			for phase in range(phases):
+				for z in range(n_slices):
+					offset = 1.25 if kind == "aq" and phase == 2 else 0.0
+					slice_info = {
+						"InstanceNumber": instance,
+						"AcquisitionNumber": phase + 1 if kind == "aq" else 1,
+						"AcquisitionTime": f"{start_time + phase:06d}.{rng.randint(0, 99):02d}",
+						"SliceLocation": z * 2.5 + offset,
+					}
+					# 文件名随机, 遍历顺序与切片顺序无关
+					file_name = f"IM{rng.randrange(10**9):09d}"
+					write_slice(
+						os.path.join(series_path, file_name),
+						study,
+						series,
+						slice_info,
+						rows,
+						cols,
+						implicit=se % 2 == 1,
+					)
+					instance += 1
+			stats["dicom"] += instance - 1
+			stats["expected_outputs"] += EXPECTED_OUTPUTS[kind]
+		if junk:
+			with open(os.path.join(study_path, "report.txt"), "w") as f:
+				f.write("not a DICOM file\n" * 100)
+			with open(os.path.join(study_path, "preview.jpg"), "wb") as f:
+				f.write(b"\xff\xd8\xff\xe0" + bytes(rng.randrange(256) for _ in range(4096)))
+			open(os.path.join(study_path, "empty"), "wb").close()
+			stats["junk"] += 3
+	if filtered_study:
+		stats["filtered_study"] = study["PatientID"]
+	stats["files"] = stats["dicom"] + stats["junk"]
+	return stats
+
+
+# 流水线测试的配置, 第一个为参考配置, 其余配置的输出必须与其一致
+PIPELINE_CONFIGS = [
+	("default", {}),
+	("fast_metadata", {"fast_metadata": True}),
+	("prune", {"prune": True}),
+	("pixel_reader_pydicom", {"pixel_reader": "pydicom"}),
+	("single_pass", {"single_pass": True}),
+	("stream", {"stream_threshold": 0}),
+	("geometry", {"split_mode": "geometry"}),
+	("prefetch", {"prefetch": 16}),
+]
+
+
+def output_digest(split_list, save_path):
+	"""拆分结果 (每个输出对应的文件) 和输出体数据的哈希, 用于比较不同配置的输出是否一致"""
+	split_hash = hashlib.md5()
+	for series_data in split_list:
+		files = [os.path.basename(x) for x in series_data.files]
+		save_file = os.path.relpath(series_data.get_save_file(), save_path)
+		split_hash.update(json.dumps([save_file, files]).encode())
+	voxel_hash = hashlib.md5()
+	for series_data in split_list:
+		image = sitk.ReadImage(series_data.get_save_file())
+		voxel_hash.update(sitk.GetArrayViewFromImage(image).tobytes())
+		voxel_hash.update(
+			json.dumps(
+				[
+					[round(x, 4) for x in image.GetSpacing()],
+					[round(x, 4) for x in image.GetOrigin()],
+					[round(x, 4) for x in image.GetDirection()],
+				]
+			).encode()
+		)
+	return split_hash.hexdigest(), voxel_hash.hexdigest()
+
+
+def bench_pipeline(
+	data_path, configs=None, n_jobs=4, min_slices=10, work_dir=None, filtered_path=None
+):
+	"""
+	对 data_path 按每种配置完整运行一次 (拆分 + 保存), 返回各阶段耗时和输出是否一致
+	filtered_path: 切片全部被过滤的检查目录, 每种配置单独拆分一次, 应返回空列表而不是出错
+	"""
+	configs = configs or PIPELINE_CONFIGS
+	results = []
+	reference = None
+	for name, kwargs in configs:
+		with tempfile.TemporaryDirectory(dir=work_dir) as save_path:
+			split = DicomSeriesSplit(
+				n_jobs=n_jobs,
+				min_slices=min_slices,
+				meta_keys=APP_META_KEYS,
+				will_save_file_keys=["SeriesDescription", "ProtocolName"],
+				will_save_root_path=save_path,
+				**kwargs,
+			)
+			start = time.perf_counter()
+			split_list = split(data_path)
+			reports = split.export(split_list)
+			seconds = time.perf_counter() - start
+			digest = output_digest(split_list, save_path)
+			names = sorted(
+				os.path.relpath(x.get_save_file(), save_path).replace(os.sep, "/")
+				for x in split_list
+			)
+			filtered = split(filtered_path) if filtered_path is not None else []
+		reference = reference or digest
+		results.append(
+			{
+				"config": name,
+				"seconds": round(seconds, 3),
+				"outputs": len(split_list),
+				"failed": sum(x["status"] == "failed" for x in reports),
+				"equivalent": digest == reference,
+				"names": names,
+				"filtered_empty": filtered == [],
+				"stages": split.profiler.report()["stages"],
+			}
+		)
+	return results
+
+
+def peak_rss_mb():
+	"""当前进程的峰值 RSS (MB), Linux 上 ru_maxrss 单位为 KB, macOS 上为字节"""
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak / (1024**2 if sys.platform == "darwin" else 1024)
+
+
+def export_peak_rss(data_path, save_path, kwargs):
+	"""在新进程中运行: 拆分并保存, 返回保存过程使峰值 RSS 增加的量和输出的哈希"""
+	logger.remove()
+	split = DicomSeriesSplit(
+		n_jobs=1,
+		min_slices=1,
+		meta_keys=APP_META_KEYS,
+		will_save_file_keys=["SeriesDescription", "ProtocolName"],
+		will_save_root_path=save_path,
+		**kwargs,
+	)
+	split_list = split(data_path)
+	before = peak_rss_mb()
+	start = time.perf_counter()
+	reports = split.export(split_list)
+	seconds = time.perf_counter() - start
+	peak_delta = peak_rss_mb() - before
+	return {
+		"seconds": round(seconds, 3),
+		"peak_delta_mb": round(peak_delta, 1),
+		"failed": sum(x["status"] == "failed" for x in reports),
+		"digest": output_digest(split_list, save_path),
+	}
+
+
+# 内存测试的配置: 组装整个体数据后写入 / 逐块写入
+MEMORY_CONFIGS = [
+	("whole", {"pixel_reader": "pydicom"}),
+	("stream", {"stream_threshold": 0}),
+	("stream_gzip_jobs_4", {"stream_threshold": 0, "gzip_jobs": 4}),
+]
+
+
+def bench_memory(data_path, configs=None, work_dir=None):
+	"""每种配置在新进程中保存 data_path 的序列, 返回耗时, 峰值 RSS 增量和输出是否一致"""
+	configs = configs or MEMORY_CONFIGS
+	results = []
+	reference = None
+	for name, kwargs in configs:
+		with tempfile.TemporaryDirectory(dir=work_dir) as save_path:
+			with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+				result = executor.submit(
+					export_peak_rss, data_path, save_path, kwargs
+				).result()
+		digest = result.pop("digest")
+		reference = reference or digest
+		results.append({"config": name, **result, "equivalent": digest == reference})
+	return results
+
+
+class LatencyOpener:
+	"""
+	注入延迟的假文件系统, 代替 open 传给 opener: 每次打开和每次 read 等待一次往返 (latency 秒, 上下浮动 jitter)
+	同时最多 capacity 个请求被处理, 超出的排队, 模拟并发过高时延迟上升的网络存储
+	"""
+
+	def __init__(self, latency=0.005, capacity=16, jitter=0.2, seed=0):
+		self.latency = latency
+		self.capacity = capacity
+		self.jitter = jitter
+		self.requests = 0
+		self._random = random.Random(seed)
+		self._slots = threading.BoundedSemaphore(capacity)
+		self._lock = threading.Lock()
+
+	def wait(self):
+		with self._lock:
+			self.requests += 1
+			delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+		with self._slots:
+			time.sleep(delay)
+
+	def __call__(self, path, mode="rb"):
+		self.wait()
+		return LatencyFile(open(path, mode), self)
+
+
+class LatencyFile:
+	"""LatencyOpener 打开的文件, read 等待一次往返, seek / tell 等在本地完成"""
+
+	def __init__(self, fp, opener):
+		self.fp = fp
+		self.opener = opener
+
+	def read(self, size=-1):
+		self.opener.wait()
+		return self.fp.read(size)
+
+	def __getattr__(self, name):
+		return getattr(self.fp, name)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.fp.close()
+
+
+# 预读测试的配置: read_metadata_list 的参数, prefetch 为 Prefetcher 的参数
+PREFETCH_CONFIGS = [
+	("threads_8", {"n_jobs": 8}),
+	("threads_8_fast", {"n_jobs": 8, "fast": True}),
+	("threads_32_fast", {"n_jobs": 32, "fast": True}),
+	("prefetch_fixed_32", {"prefetch": {"max_outstanding": 32, "adaptive": False}}),
+	("prefetch_adaptive_64", {"prefetch": {"max_outstanding": 64}}),
+]
+
+
+def bench_prefetch(data_path, configs=None, latency=0.005, capacity=16):
+	"""
+	在注入延迟的假文件系统上读取 data_path 下所有文件的元数据
+	返回每种配置的吞吐和结果是否与直接读取一致, 自适应配置同时返回在途读取数的变化
+	"""
+	configs = configs or PREFETCH_CONFIGS
+	files = sorted(
+		os.path.join(root, name)
+		for root, _, names in os.walk(data_path)
+		for name in names
+	)
+	reference = [
+		(file, metadata)
+		for file, metadata, _, _ in read_metadata_list(files, APP_META_KEYS, sniff=True)
+	]
+	results = []
+	for name, kwargs in configs:
+		kwargs = dict(kwargs)
+		opener = LatencyOpener(latency, capacity)
+		prefetch = kwargs.pop("prefetch", None)
+		if prefetch is not None:
+			prefetch = Prefetcher(opener=opener, **prefetch)
+		start = time.perf_counter()
+		metadata_list = [
+			(file, metadata)
+			for file, metadata, _, _ in read_metadata_list(
+				files,
+				APP_META_KEYS,
+				sniff=True,
+				opener=opener,
+				prefetch=prefetch,
+				**kwargs,
+			)
+		]
+		seconds = time.perf_counter() - start
+		results.append(
+			{
+				"config": name,
+				"seconds": round(seconds, 3),
+				"files_per_s": round(len(files) / seconds, 1),
+				"requests": opener.requests,
+				"equivalent": metadata_list == reference,
+				"outstanding": prefetch.limits[-8:] if prefetch is not None else "",
+			}
+		)
+	return results
+
+
+def lease_and_exit(queue_file, lease_seconds):
+	"""租用一个任务后直接退出, 不续租也不报告结果, 模拟处理中崩溃的工作进程"""
+	WorkQueue(queue_file).lease("crashed", lease_seconds)
+	os._exit(1)
+
+
+def queue_worker(queue_file, save_path, worker, lease_seconds, wait_seconds, split_kwargs):
+	logger.remove()
+	return run_queue_worker(
+		queue_file,
+		save_path,
+		worker=worker,
+		lease_seconds=lease_seconds,
+		wait_seconds=wait_seconds,
+		split_kwargs=split_kwargs,
+	)
+
+
+def bench_queue(data_path, n_workers=4, lease_seconds=3, work_dir=None):
+	"""
+	以相对路径把 data_path 下的检查加入临时队列, 先让一个进程租用一个任务后崩溃, 再启动 n_workers 个工作进程
+	返回耗时, 各检查的状态 / 租用次数和输出路径, 用于检查每个检查恰好处理一次, 崩溃进程的租约过期后被重新租用
+	"""
+	split_kwargs = {
+		"n_jobs": 1,
+		"will_save_file_keys": ["SeriesDescription", "ProtocolName"],
+	}
+	context = get_context("spawn")
+	with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+		queue_file = os.path.join(temp_dir, "queue.db")
+		save_path = os.path.join(temp_dir, "output")
+		os.makedirs(save_path)
+		queue = WorkQueue(queue_file)
+		queue.add(os.path.relpath(x) for x in iter_study_dirs(data_path))
+		crashed = context.Process(target=lease_and_exit, args=(queue_file, lease_seconds))
+		crashed.start()
+		crashed.join()
+		start = time.perf_counter()
+		with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+			processed = list(
+				executor.map(
+					queue_worker,
+					[queue_file] * n_workers,
+					[save_path] * n_workers,
+					[f"worker-{i}" for i in range(n_workers)],
+					[lease_seconds] * n_workers,
+					# 空闲时等待到崩溃进程的租约过期
+					[lease_seconds * 2] * n_workers,
+					[split_kwargs] * n_workers,
+				)
+			)
+		seconds = time.perf_counter() - start
+		jobs = {
+			study: {"status": status, "worker": worker, "attempts": attempts}
+			for study, status, worker, attempts in queue.conn.execute(
+				"SELECT study, status, worker, attempts FROM jobs"
+			)
+		}
+		stats = queue.stats()
+		queue.close()
+		names = sorted(
+			os.path.relpath(os.path.join(root, name), save_path).replace(os.sep, "/")
+			for root, _, files in os.walk(save_path)
+			for name in files
+		)
+	return {
+		"seconds": round(seconds, 3),
+		"workers": n_workers,
+		"processed": processed,
+		"series": stats["series"],
+		"jobs": jobs,
+		"names": names,
+	}
+
+
+def parse_scale(scale):
+	"""'NxMxK' -> (检查数, 序列数, 切片数)"""
+	n_studies, n_series, n_slices = (int(x) for x in scale.lower().split("x"))
+	return n_studies, n_series, n_slices
+
+
+def save_results(results_file, entry):
+	"""追加到结果文件, 用于不同版本之间比较"""
+	runs = []
+	if os.path.exists(results_file):
+		with open(results_file) as f:
+			runs = json.load(f)
+	runs.append(entry)
+	with open(results_file, "w") as f:
+		json.dump(runs, f, indent=2)
+
+
+def compare_results(results_file):
+	"""按 (规模, 配置) 列出各版本的总耗时"""
+	with open(results_file) as f:
+		runs = json.load(f)
+	rows = []
+	for run in runs:
+		for result in run["results"]:
+			rows.append(
+				{
+					"version": run["version"],
+					"date": run["date"],
+					"scale": run["scale"],
+					"config": result["config"],
+					"seconds": result["seconds"],
+					"files_per_s": round(run["data"]["files"] / result["seconds"], 1),
+					"equivalent": result["equivalent"],
+				}
+			)
+	rows.sort(key=lambda x: (x["scale"], x["config"], x["date"]))
+	return rows
+
+
+def print_table(results):
+	keys = list(results[0].keys())
+	print("\t".join(keys))
+	for result in results:
+		print("\t".join(str(result[k]) for k in keys))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=f"DICOM Splitter v{_version} benchmark")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+
+	compression_parser = subparsers.add_parser(
+		"compression", help="不同输出格式 / 压缩级别的写入速度"
+	)
+	compression_parser.add_argument(
+		"--shape", type=int, nargs=3, default=[128, 512, 512], help="体数据大小 Z Y X"
+	)
+	compression_parser.add_argument("--repeat", type=int, default=3)
+	compression_parser.add_argument("--work-dir", default=None)
+	compression_parser.add_argument("--json", default=None, help="结果保存为 JSON")
+
+	generate_parser = subparsers.add_parser("generate", help="生成合成 DICOM 数据")
+	generate_parser.add_argument("root_path")
+	generate_parser.add_argument("--scale", default="2x4x32", help="检查数x序列数x切片数")
+	generate_parser.add_argument("--size", type=int, default=64, help="图像大小")
+	generate_parser.add_argument("--seed", type=int, default=0)
+	generate_parser.add_argument(
+		"--no-interleave", action="store_true", help="各检查使用相同的采集时间, 不交错"
+	)
+
+	pipeline_parser = subparsers.add_parser(
+		"pipeline", help="在不同规模的合成数据上测试各阶段耗时, 检查不同配置的输出是否一致"
+	)
+	pipeline_parser.add_argument(
+		"--scales", nargs="+", default=["2x4x32", "8x8x32"], help="检查数x序列数x切片数"
+	)
+	pipeline_parser.add_argument("--size", type=int, default=64, help="图像大小")
+	pipeline_parser.add_argument("--n-jobs", type=int, default=4)
+	pipeline_parser.add_argument("--work-dir", default=None)
+	pipeline_parser.add_argument(
+		"--results", default="benchmark_results.json", help="追加保存结果的文件"
+	)
+
+	memory_parser = subparsers.add_parser(
+		"memory", help="保存单个大序列时的峰值内存, 逐块写入超过上限时返回非零"
+	)
+	memory_parser.add_argument("--slices", type=int, default=400)
+	memory_parser.add_argument("--size", type=int, default=512, help="图像大小")
+	memory_parser.add_argument(
+		"--ceiling", type=float, default=128, help="逐块写入的峰值 RSS 增量上限 (MB)"
+	)
+	memory_parser.add_argument("--work-dir", default=None)
+
+	prefetch_parser = subparsers.add_parser(
+		"prefetch", help="在注入延迟的假文件系统上比较元数据读取的吞吐, 检查预读结果是否一致"
+	)
+	prefetch_parser.add_argument("--scale", default="4x4x32", help="检查数x序列数x切片数")
+	prefetch_parser.add_argument("--size", type=int, default=64, help="图像大小")
+	prefetch_parser.add_argument(
+		"--latency", type=float, default=5, help="每次打开 / 读取的往返延迟 (ms)"
+	)
+	prefetch_parser.add_argument(
+		"--capacity", type=int, default=16, help="假文件系统同时处理的请求数"
+	)
+	prefetch_parser.add_argument("--work-dir", default=None)
+
+	queue_parser = subparsers.add_parser(
+		"queue", help="多个工作进程处理同一个任务队列, 检查每个检查恰好处理一次, 崩溃进程的租约过期后被接管"
+	)
+	queue_parser.add_argument("--scale", default="8x4x16", help="检查数x序列数x切片数")
+	queue_parser.add_argument("--size", type=int, default=32, help="图像大小")
+	queue_parser.add_argument("--workers", type=int, default=4)
+	queue_parser.add_argument("--lease", type=float, default=3, help="租约时长 (秒)")
+	queue_parser.add_argument("--work-dir", default=None)
+
+	compare_parser = subparsers.add_parser("compare", help="比较结果文件中各版本的耗时")
+	compare_parser.add_argument("--results", default="benchmark_results.json")
+
+	args = parser.parse_args(argv)
+	logger.remove()
+
+	if args.command == "compression":
+		image = make_volume(tuple(args.shape))
+		results = bench_compression(image, repeat=args.repeat, work_dir=args.work_dir)
+		print_table(results)
+		if args.json:
+			with open(args.json, "w") as f:
+				json.dump({"version": _version, "shape": args.shape, "results": results}, f, indent=2)
+	elif args.command == "generate":
+		n_studies, n_series, n_slices = parse_scale(args.scale)
+		stats = generate_archive(
+			args.root_path,
+			n_studies,
+			n_series,
+			n_slices,
+			args.size,
+			args.size,
+			seed=args.seed,
+			interleave=not args.no_interleave,
+		)
+		print(json.dumps(stats, indent=2))
+	elif args.command == "pipeline":
+		for scale in args.scales:
+			n_studies, n_series, n_slices = parse_scale(scale)
+			with tempfile.TemporaryDirectory(dir=args.work_dir) as data_path:
+				data = generate_archive(
+					data_path,
+					n_studies,
+					n_series,
+					n_slices,
+					args.size,
+					args.size,
+					filtered_study=True,
+				)
+				results = bench_pipeline(
+					data_path,
+					n_jobs=args.n_jobs,
+					work_dir=args.work_dir,
+					filtered_path=os.path.join(data_path, data["filtered_study"]),
+				)
+			# 各检查的采集时间交错, 检查输出文件名 (每个检查独立编号) 与预期完全一致
+			names = expected_names(n_studies, n_series, n_slices)
+			for result in results:
+				result["expected"] = (
+					result["outputs"] == data["expected_outputs"]
+					and result.pop("names") == names
+					and result.pop("filtered_empty")
+				)
+			print(f"scale {scale}: {data}")
+			print_table(
+				[{k: v for k, v in x.items() if k != "stages"} for x in results]
+			)
+			save_results(
+				args.results,
+				{
+					"version": _version,
+					"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+					"platform": platform.platform(),
+					"python": platform.python_version(),
+					"scale": scale,
+					"size": args.size,
+					"n_jobs": args.n_jobs,
+					"data": data,
+					"results": results,
+				},
+			)
+			if not all(x["equivalent"] and x["expected"] for x in results):
+				raise SystemExit(f"Output mismatch at scale {scale}.")
+	elif args.command == "memory":
+		if resource is None:
+			raise SystemExit("memory benchmark needs the resource module (Linux / macOS).")
+		with tempfile.TemporaryDirectory(dir=args.work_dir) as data_path:
+			generate_archive(
+				data_path, 1, 1, args.slices, args.size, args.size, junk=False
+			)
+			results = bench_memory(data_path, work_dir=args.work_dir)
+		volume_mb = args.slices * args.size**2 * 2 / 1024**2
+		print(f"volume {volume_mb:.1f} MB, ceiling {args.ceiling} MB")
+		print_table(results)
+		streams = [x for x in results if x["config"].startswith("stream")]
+		if not all(x["equivalent"] and not x["failed"] for x in results):
+			raise SystemExit("Output mismatch.")
+		if any(x["peak_delta_mb"] > args.ceiling for x in streams):
+			raise SystemExit(f"Peak memory of stream writing exceeds {args.ceiling} MB.")
+	elif args.command == "prefetch":
+		n_studies, n_series, n_slices = parse_scale(args.scale)
+		with tempfile.TemporaryDirectory(dir=args.work_dir) as data_path:
+			data = generate_archive(
+				data_path, n_studies, n_series, n_slices, args.size, args.size
+			)
+			results = bench_prefetch(
+				data_path, latency=args.latency / 1000, capacity=args.capacity
+			)
+		print(f"scale {args.scale}: {data}, latency {args.latency} ms")
+		print_table(results)
+		if not all(x["equivalent"] for x in results):
+			raise SystemExit("Metadata mismatch.")
+	elif args.command == "queue":
+		n_studies, n_series, n_slices = parse_scale(args.scale)
+		with tempfile.TemporaryDirectory(dir=args.work_dir) as data_path:
+			data = generate_archive(
+				data_path, n_studies, n_series, n_slices, args.size, args.size
+			)
+			result = bench_queue(data_path, args.workers, args.lease, args.work_dir)
+		jobs = result.pop("jobs")
+		attempts = Counter(x["attempts"] for x in jobs.values())
+		checks = {
+			"absolute": all(os.path.isabs(x) for x in jobs),
+			"all_done": all(x["status"] == "done" for x in jobs.values()),
+			# 崩溃进程租用的检查租用两次, 其余一次
+			"attempts": attempts == Counter({1: n_studies - 1, 2: 1}),
+			"processed_once": sum(result["processed"]) == n_studies,
+			"outputs": sum(result["series"].values()) == data["expected_outputs"],
+			"names": result.pop("names") == expected_names(n_studies, n_series, n_slices),
+		}
+		print(f"scale {args.scale}: {data}, lease {args.lease} s")
+		print_table([{**result, **checks}])
+		if not all(checks.values()):
+			raise SystemExit("Queue mismatch.")
+	elif args.command == "compare":
+		print_table(compare_results(args.results))
+
+
+if __name__ == "__main__":
+	main()